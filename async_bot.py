@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue
+from typing import Any, Callable, Dict, Optional
+
+from telegram import Bot, TelegramError, ReplyKeyboardMarkup
+from telegram import update as update_type
+from telegram.ext import CallbackContext, Dispatcher, JobQueue, Updater
+from telegram.ext import callbackcontext
+from telegram.utils.request import Request
+
+import main as bot
+import metrics
+from forecast import WeatherForecast
+from metrics import HANDLER_SECONDS, RENDER_SECONDS
+from repository import with_session
+from single_flight import AsyncSingleFlight
+from weather_client import AsyncWeatherClient
+
+ASYNC_CONCURRENCY = int(os.getenv('ASYNC_CONCURRENCY', 500))
+ASYNC_QUEUE_SIZE = int(os.getenv('ASYNC_QUEUE_SIZE', 1000))
+ASYNC_IO_THREADS = int(os.getenv('ASYNC_IO_THREADS', 32))
+ASYNC_DRAIN_TIMEOUT = float(os.getenv('ASYNC_DRAIN_TIMEOUT', 30))
+
+logger = logging.getLogger(__name__)
+
+weather_client = AsyncWeatherClient(bot.weather_client)
+forecast_requests = AsyncSingleFlight(failure_ttl=bot.FORECAST_FAILURE_TTL)
+
+
+class AsyncDispatcher(Dispatcher):
+    """Диспетчер, который обрабатывает обновления как корутины в отдельном цикле событий.
+    Для обработчика из main ищется одноименная корутина в coroutines, остальные обработчики
+    выполняются в пуле потоков цикла событий.
+    Одновременно обрабатывается не больше concurrency обновлений. Когда все слоты заняты,
+    диспетчер перестает забирать обновления из очереди размером queue_size,
+    а при ее заполнении приостанавливается получение обновлений от Telegram."""
+
+    def __init__(self,
+                 bot_: Bot,
+                 coroutines: Dict[str, Callable],
+                 concurrency: int = ASYNC_CONCURRENCY,
+                 queue_size: int = ASYNC_QUEUE_SIZE,
+                 io_threads: int = ASYNC_IO_THREADS) -> None:
+        super().__init__(bot_, Queue(maxsize=queue_size), workers=1, job_queue=JobQueue())
+        self.coroutines = coroutines
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='async_io'))
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='async_loop', daemon=True)
+        self._loop_thread.start()
+
+    def process_update(self, update: Any) -> None:
+        if isinstance(update, TelegramError):
+            super().process_update(update)
+            return
+        self._slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(self._process(update), self.loop)
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def stop(self) -> None:
+        """Останавливает диспетчер, дожидаясь обработки уже принятых обновлений."""
+        super().stop()
+        with self._pending_lock:
+            pending = list(self._pending)
+        if pending:
+            logger.info('Ожидание обработки %s обновлений.', len(pending))
+            wait(pending, timeout=ASYNC_DRAIN_TIMEOUT)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _done(self, future) -> None:
+        with self._pending_lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    async def _process(self, update: update_type) -> None:
+        context = None
+        for group in self.groups:
+            for handler in self.handlers[group]:
+                check = handler.check_update(update)
+                if check is None or check is False:
+                    continue
+                if context is None:
+                    context = CallbackContext.from_update(update, self)
+                handler.collect_additional_context(context, update, self, check)
+                coroutine = self.coroutines.get(handler.callback.__name__)
+                try:
+                    if coroutine:
+                        with HANDLER_SECONDS.time(handler.callback.__name__):
+                            await coroutine(update, context)
+                    else:
+                        await run_blocking(handler.callback, update, context)
+                except Exception as error:
+                    logger.exception('Ошибка при обработке обновления: %s.', error)
+                break
+
+
+async def run_blocking(func: Callable, *args: Any) -> Any:
+    """Выполняет блокирующую функцию (база данных, отправка сообщения) в пуле потоков цикла событий.
+    Функции, обращающиеся к базе данных, оборачиваются в with_session, чтобы сессия потока закрывалась после вызова."""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def send_message(update: update_type,
+                       context: callbackcontext,
+                       text: str,
+                       keyboard: Optional[ReplyKeyboardMarkup] = None) -> None:
+    await run_blocking(bot.send_message, update, context, text, keyboard)
+
+
+async def get_forecast(latitude: float, longitude: float) -> Optional[WeatherForecast]:
+    """Асинхронный вариант main.get_forecast."""
+    key, tile_latitude, tile_longitude = bot.forecast_cache.tile(latitude, longitude)
+    bot.forecast_refresher.track(key, tile_latitude, tile_longitude)
+    forecast, fresh = await run_blocking(bot.forecast_cache.lookup, key)
+    if fresh:
+        logger.info('Прогноз для квадрата %s взят из кэша.', key)
+        return forecast
+    if forecast:
+        logger.info('Прогноз для квадрата %s устарел, отправлен из кэша и обновляется в фоне.', key)
+        bot.forecast_refresher.revalidate(key, tile_latitude, tile_longitude)
+        return forecast
+
+    async def fetch() -> Optional[WeatherForecast]:
+        response = await weather_client.get_forecast(tile_latitude, tile_longitude)
+        fetched = bot.parse_weather(response) if response else None
+        if fetched:
+            await run_blocking(bot.forecast_cache.put, key, fetched)
+        return fetched
+
+    return await forecast_requests.do(key, fetch)
+
+
+async def handler_get_coordinates(update: update_type, context: callbackcontext) -> None:
+    """Асинхронный вариант main.handler_get_coordinates."""
+    chat_id = update.effective_chat.id
+    location = update.message.location if update.message else None
+    if not location:
+        logger.error('Не удалось определить координаты пользователя %s.', chat_id)
+        return
+    city = bot.get_city(location.latitude, location.longitude)
+    if await run_blocking(with_session(bot.create_update_user), chat_id, update.effective_chat.username,
+                          location.latitude, location.longitude, city):
+        await handler_get_weather(update, context)
+    else:
+        await send_message(update, context, 'Ваше местоположение не изменилось.', bot.main_keyboard)
+
+
+async def handler_get_weather(update: update_type, context: callbackcontext) -> None:
+    """Асинхронный вариант main.handler_get_weather."""
+    chat_id = update.effective_chat.id
+    user = bot.get_user(chat_id)
+    if not user:
+        logger.error('Не был найден пользователь id: %s.', chat_id)
+        await send_message(update, context, bot.NO_LOCATION_TEXT, bot.start_keyboard)
+        return
+
+    forecast = await get_forecast(user.latitude, user.longitude)
+    note = None
+    if not forecast:
+        forecast, note = bot.get_fallback_forecast(user.latitude, user.longitude) or (None, None)
+    if forecast:
+        horizon = bot.get_horizon(update)
+        with RENDER_SECONDS.time(horizon):
+            text = bot.render_forecast(forecast, horizon)
+        if note:
+            text = f'{text}\n\n{note}'
+        bot.update_last_message(chat_id, text)
+    else:
+        text = bot.ERROR_TEXT
+    await send_message(update, context, text, bot.main_keyboard)
+
+
+COROUTINES = {
+    'handler_get_coordinates': handler_get_coordinates,
+    'handler_get_weather': handler_get_weather,
+}
+
+
+def create_updater() -> Updater:
+    """Создает Updater с асинхронным диспетчером."""
+    request = Request(con_pool_size=ASYNC_IO_THREADS + 4)
+    dispatcher = AsyncDispatcher(Bot(token=bot.TOKEN, request=request), COROUTINES)
+    # Число потоков Updater задается только для собственного диспетчера
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def check() -> bool:
+    """Проверка запуска без подключения к Telegram: создает Updater, добавляет обработчики
+    и планирует рассылку. Возвращает True, если задачи рассылки запланированы."""
+    updater = create_updater()
+    bot.add_handlers(updater.dispatcher)
+    delivery = bot.start_broadcasts(updater.dispatcher)
+    try:
+        missing = [name for name in ('broadcast_prefetch', 'broadcast_send')
+                   if not updater.job_queue.get_jobs_by_name(name)]
+    finally:
+        delivery.stop()
+        updater.dispatcher.stop()
+    if missing:
+        logger.critical('Не запланированы задачи рассылки: %s.', ', '.join(missing))
+        return False
+    logger.info('Проверка запуска пройдена.')
+    return True
+
+
+def main() -> None:
+    """Запуск бота в асинхронном режиме. С аргументом --check только проверяет запуск."""
+    if not bot.check_env():
+        logger.critical('Не найдены переменные виртуального окружения')
+        sys.exit()
+    if '--check' in sys.argv[1:]:
+        sys.exit(0 if check() else 1)
+
+    bot.user_registry.load()
+    bot.fill_cities()
+    bot.forecast_cache.load()
+    bot.last_message_writer.start()
+    bot.forecast_refresher.start()
+    metrics.start(bot.METRICS_HOST, bot.METRICS_PORT, bot.METRICS_DUMP_FILE, bot.METRICS_DUMP_INTERVAL)
+    updater = create_updater()
+    bot.add_handlers(updater.dispatcher)
+    delivery = bot.start_broadcasts(updater.dispatcher)
+
+    updater.start_polling()
+    updater.idle()
+    delivery.stop()
+    bot.forecast_refresher.stop()
+    bot.last_message_writer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict
+
+from forecast import HORIZON_3H, HORIZON_5D, HORIZON_24H, WeatherForecast, render_forecast
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+# момент, на который формируются сообщения: внутри записанных прогнозов
+NOW = datetime(2025, 10, 17, 5, 0)
+
+
+def load_fixtures() -> Dict[str, dict]:
+    return {path.stem: json.loads(path.read_text(encoding='utf-8')) for path in sorted(FIXTURES.glob('*.json'))}
+
+
+def cases(responses: Dict[str, dict]) -> Dict[str, Callable[[], object]]:
+    """Замеряемые операции: разбор ответа API, упаковка для кэша и формирование сообщений."""
+    result = {}
+    for name, response in responses.items():
+        forecast = WeatherForecast.from_response(response)
+        data = forecast.to_bytes()
+        result[f'{name}: parse'] = lambda response=response: WeatherForecast.from_response(response)
+        result[f'{name}: to_bytes'] = forecast.to_bytes
+        result[f'{name}: from_bytes'] = lambda data=data: WeatherForecast.from_bytes(data)
+        for horizon in (HORIZON_3H, HORIZON_24H, HORIZON_5D):
+            result[f'{name}: render {horizon}'] = (
+                lambda forecast=forecast, horizon=horizon: render_forecast(forecast, horizon, NOW))
+    return result
+
+
+def run(number: int, repeat: int) -> Dict[str, float]:
+    """Возвращает лучшее время одной операции в микросекундах."""
+    results = {}
+    for name, func in cases(load_fixtures()).items():
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        results[name] = best / number * 1e6
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Микробенчмарк разбора прогноза и формирования сообщений.')
+    parser.add_argument('--number', type=int, default=2000, help='вызовов в одном замере')
+    parser.add_argument('--repeat', type=int, default=5, help='число замеров, берется лучший')
+    parser.add_argument('--save', type=Path, help='сохранить результаты в json как базовые')
+    parser.add_argument('--compare', type=Path, help='сравнить с базовыми результатами из json')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='допустимое замедление относительно базовых результатов, 0.2 - на 20%%')
+    args = parser.parse_args()
+
+    results = run(args.number, args.repeat)
+    baseline = json.loads(args.compare.read_text()) if args.compare else {}
+    regressions = []
+    for name, micros in results.items():
+        line = f'{name:<40} {micros:10.2f} мкс {1e6 / micros:12.0f} оп/с'
+        if name in baseline:
+            change = micros / baseline[name] - 1
+            line += f' {change:+8.1%}'
+            if change > args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+    if regressions:
+        print(f'Замедление больше {args.tolerance:.0%}: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
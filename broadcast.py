@@ -0,0 +1,107 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import ReplyKeyboardMarkup
+from telegram.ext import CallbackContext, JobQueue
+
+from delivery import DeliveryQueue
+from forecast import HORIZON_24H, WeatherForecast, render_forecast
+from metrics import RENDER_SECONDS
+from repository import SubscriptionRepository
+from user_registry import UserRegistry
+
+logger = logging.getLogger(__name__)
+
+Group = Tuple[float, float, List[int]]
+# Прогноз и необязательное пояснение к нему, например что прогноз взят для соседнего места
+Result = Tuple[WeatherForecast, Optional[str]]
+
+
+class Broadcaster:
+    """Утренняя рассылка прогноза подписчикам.
+    Подписчики группируются по квадратам координат (tile), прогноз для каждого квадрата
+    запрашивается один раз, параллельно в workers потоков, и сообщение формируется один раз на квадрат.
+    Прогнозы запрашиваются заранее (prefetch), к моменту рассылки они уже в кэше. Запросы prefetch
+    ждут квоту API до начала рассылки, поэтому при малой квоте они распределяются по всему интервалу prefetch.
+    С reload_users реестр пользователей перечитывается из базы перед группировкой."""
+
+    def __init__(self,
+                 subscriptions: SubscriptionRepository,
+                 registry: UserRegistry,
+                 tile: Callable[[float, float], Tuple[str, float, float]],
+                 get_forecast: Callable[[float, float, float], Optional[Result]],
+                 delivery: DeliveryQueue,
+                 keyboard: Optional[ReplyKeyboardMarkup] = None,
+                 workers: int = 16,
+                 reload_users: bool = False) -> None:
+        self.subscriptions = subscriptions
+        self.registry = registry
+        self.tile = tile
+        self.get_forecast = get_forecast
+        self.delivery = delivery
+        self.keyboard = keyboard
+        self.workers = workers
+        self.reload_users = reload_users
+        self.prefetch_lead = timedelta(0)
+
+    def schedule(self, job_queue: JobQueue, at: time, prefetch_lead: timedelta) -> None:
+        """Планирует ежедневные запрос прогнозов за prefetch_lead до рассылки и саму рассылку в at."""
+        self.prefetch_lead = prefetch_lead
+        prefetch_at = (datetime.combine(datetime.today(), at) - prefetch_lead).time().replace(tzinfo=at.tzinfo)
+        job_queue.run_daily(self.prefetch, time=prefetch_at, name='broadcast_prefetch')
+        job_queue.run_daily(self.send, time=at, name='broadcast_send')
+        logger.info('Рассылка запланирована на %s, запрос прогнозов на %s.', at, prefetch_at)
+
+    def groups(self) -> Dict[str, Group]:
+        """Подписчики по квадратам: ключ квадрата -> (широта центра, долгота центра, chat_id подписчиков)."""
+        if self.reload_users:
+            self.registry.load()
+        groups = {}
+        for chat_id in self.subscriptions.chat_ids():
+            user = self.registry.get(chat_id)
+            if not user:
+                continue
+            key, latitude, longitude = self.tile(user.latitude, user.longitude)
+            groups.setdefault(key, (latitude, longitude, []))[2].append(chat_id)
+        return groups
+
+    def fetch(self, groups: Dict[str, Group], budget: float = 0) -> Dict[str, Optional[Result]]:
+        """Параллельно получает прогнозы для всех квадратов. Все запросы должны уложиться в budget секунд:
+        каждый ждет квоту API не дольше, чем осталось до конца этого срока."""
+        deadline = monotonic() + budget
+
+        def get(group: Group) -> Optional[Result]:
+            return self.get_forecast(group[0], group[1], max(0.0, deadline - monotonic()))
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast') as executor:
+            return dict(zip(groups, executor.map(get, groups.values())))
+
+    def prefetch(self, context: Optional[CallbackContext] = None) -> None:
+        groups = self.groups()
+        results = self.fetch(groups, self.prefetch_lead.total_seconds())
+        # Ближайший прогноз из кэша вместо прогноза квадрата тоже неудача
+        failed = sum(1 for result in results.values() if not result or result[1])
+        logger.info('Перед рассылкой запрошены прогнозы для %s квадратов, не удалось для %s.', len(groups), failed)
+
+    def send(self, context: Optional[CallbackContext] = None) -> None:
+        groups = self.groups()
+        results = self.fetch(groups)
+        queued = 0
+        for key, (_, _, chat_ids) in groups.items():
+            result = results[key]
+            if not result:
+                logger.error('Нет прогноза для квадрата %s, рассылка для %s подписчиков пропущена.',
+                             key, len(chat_ids))
+                continue
+            forecast, note = result
+            with RENDER_SECONDS.time(HORIZON_24H):
+                text = render_forecast(forecast, HORIZON_24H)
+            if note:
+                text = f'{text}\n\n{note}'
+            for chat_id in chat_ids:
+                self.delivery.put(chat_id, text, self.keyboard)
+            queued += len(chat_ids)
+        logger.info('В очередь рассылки поставлено сообщений: %s, квадратов: %s.', queued, len(groups))
@@ -1,13 +1,48 @@
+import os
 from datetime import datetime
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, DateTime, String, Integer, Float
-from sqlalchemy.orm import declarative_base
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy import Column, DateTime, String, Integer, Float, LargeBinary
+from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
-engine = create_engine('sqlite:///db.sqlite', echo=False)
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///db.sqlite')
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 5))
+
+# Соединения пула передаются между потоками, для SQLite это нужно разрешить явно
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == 'sqlite'
+
+engine = create_engine(DATABASE_URL,
+                       echo=False,
+                       poolclass=QueuePool,
+                       pool_size=DATABASE_POOL_SIZE,
+                       max_overflow=DATABASE_POOL_SIZE * 2,
+                       connect_args={'check_same_thread': False} if IS_SQLITE else {})
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+db_session = scoped_session(SessionLocal)
 Base = declarative_base()
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Настройки SQLite для каждого нового соединения.
+    WAL позволяет читать базу во время записи, synchronous=NORMAL в режиме WAL
+    не делает fsync на каждый commit, а только при переносе журнала в базу."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+if IS_SQLITE:
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -20,4 +55,25 @@ class User(Base):
     last_message = Column(String, default=None)
 
 
+class Subscription(Base):
+    __tablename__ = 'subscriptions'
+    chat_id = Column(Integer, primary_key=True)
+    created_date = Column(DateTime(), default=datetime.now)
+
+
+class Forecast(Base):
+    __tablename__ = 'forecasts'
+    tile = Column(String, primary_key=True)
+    updated = Column(DateTime(), default=datetime.now)
+    payload = Column(LargeBinary)
+
+
+class Quota(Base):
+    __tablename__ = 'api_quota'
+    name = Column(String, primary_key=True)
+    tokens = Column(Float)
+    # Время последнего пополнения, unix time
+    updated = Column(Float)
+
+
 Base.metadata.create_all(engine)
@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from queue import Queue
+from typing import Callable, Dict, Optional
+
+from telegram import Bot, ReplyKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+from metrics import SEND_SECONDS, TELEGRAM_ERRORS
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryQueue:
+    """Очередь отправки сообщений рассылки с учетом ограничений Telegram.
+    Всего отправляется не больше rate сообщений в секунду, в один чат - не чаще раза в per_chat_interval секунд.
+    При RetryAfter отправка приостанавливается для всех потоков на указанное Telegram время и сообщение
+    отправляется повторно, при сетевых ошибках делается до max_attempts попыток.
+    Если пользователь заблокировал бота, вызывается on_forbidden(chat_id)."""
+
+    def __init__(self,
+                 bot: Bot,
+                 rate: float = 25,
+                 per_chat_interval: float = 1,
+                 workers: int = 8,
+                 max_attempts: int = 3,
+                 on_forbidden: Optional[Callable[[int], None]] = None) -> None:
+        self.bot = bot
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.on_forbidden = on_forbidden
+        self.sent = 0
+        self.failed = 0
+        self._queue = Queue()
+        self._last_sent: Dict[int, float] = {}
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def put(self, chat_id: int, text: str, keyboard: Optional[ReplyKeyboardMarkup] = None) -> None:
+        self._queue.put((chat_id, text, keyboard, 1))
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'delivery_{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Останавливает отправку, неотправленные сообщения отбрасываются."""
+        dropped = 0
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            dropped += 1
+        if dropped:
+            logger.warning('Остановка рассылки, не отправлено сообщений: %s.', dropped)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._send(*item)
+            except Exception as error:
+                logger.exception('Ошибка при отправке сообщения рассылки: %s.', error)
+
+    def _send(self, chat_id: int, text: str, keyboard: Optional[ReplyKeyboardMarkup], attempt: int) -> None:
+        self._wait(chat_id)
+        try:
+            self._deliver(chat_id, text, keyboard)
+        except RetryAfter as error:
+            logger.warning('Telegram просит подождать %s с перед отправкой.', error.retry_after)
+            with self._lock:
+                self._pause_until = max(self._pause_until, time.monotonic() + error.retry_after)
+            self._queue.put((chat_id, text, keyboard, attempt))
+        except Unauthorized as error:
+            logger.info('Пользователь %s недоступен для рассылки: %s.', chat_id, error)
+            self.failed += 1
+            if self.on_forbidden:
+                self.on_forbidden(chat_id)
+        except BadRequest as error:
+            logger.error('Не удалось отправить рассылку пользователю %s. Ошибка: %s.', chat_id, error)
+            self.failed += 1
+        except NetworkError as error:
+            if attempt < self.max_attempts:
+                self._queue.put((chat_id, text, keyboard, attempt + 1))
+            else:
+                logger.error('Не удалось отправить рассылку пользователю %s. Ошибка: %s.', chat_id, error)
+                self.failed += 1
+        except TelegramError as error:
+            logger.error('Не удалось отправить рассылку пользователю %s. Ошибка: %s.', chat_id, error)
+            self.failed += 1
+        else:
+            self.sent += 1
+
+    def _deliver(self, chat_id: int, text: str, keyboard: Optional[ReplyKeyboardMarkup]) -> None:
+        with SEND_SECONDS.time('broadcast'):
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+            except TelegramError as error:
+                TELEGRAM_ERRORS.inc('broadcast', type(error).__name__)
+                raise
+
+    def _wait(self, chat_id: int) -> None:
+        """Ждет, пока отправка в чат chat_id не нарушит ограничения Telegram."""
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                delay = max(self._pause_until - now,
+                            self._last_sent.get(chat_id, -self.per_chat_interval) + self.per_chat_interval - now)
+                if delay <= 0:
+                    delay = self.bucket.try_acquire()
+                if delay <= 0:
+                    self._last_sent[chat_id] = now
+                    if len(self._last_sent) > 10000:
+                        self._last_sent = {chat: sent for chat, sent in self._last_sent.items()
+                                           if sent > now - self.per_chat_interval}
+                    return
+            time.sleep(delay)
@@ -0,0 +1,223 @@
+import logging
+import struct
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
+
+from get_emoji import CALENDAR, CITY, CLOCK, DROPLET, EMOJI, SUNRISE, SUNSET, THERMOMETER, UNKNOWN, WIND
+
+logger = logging.getLogger(__name__)
+
+HORIZON_3H = '3h'
+HORIZON_24H = '24h'
+HORIZON_5D = '5d'
+
+SLOT_SECONDS = 3 * 60 * 60
+DAY_SECONDS = 24 * 60 * 60
+EPOCH = datetime(1970, 1, 1)
+WEEKDAYS = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+# Скорость ветра до WIND_LIMITS[i] включительно описывается WIND_TEXTS[i]
+WIND_LIMITS = (1.5, 5.4, 10.7, 17.1)
+WIND_TEXTS = ('Ветра нет', 'Легкий ветерок', 'Ветер', 'Сильный ветер', 'Шторм')
+# Время «ЧЧ:ММ» для каждой минуты суток
+TIMES = tuple(f'{minute // 60:02d}:{minute % 60:02d}' for minute in range(24 * 60))
+
+HEADER_TEMPLATE = CITY + ' Погода в: {}.\n\n'
+SLOT_TEMPLATE = (CLOCK + ' {} в {}\n'
+                 '{} {}.\n'
+                 + THERMOMETER + ' Температура {}°C (ощущается {}°C).\n'
+                 + DROPLET + ' Влажность {}%.\n'
+                 + WIND + ' {} ({} м/с).\n\n')
+DAY_TEMPLATE = (CALENDAR + ' {}\n'
+                '{} {}.\n'
+                + THERMOMETER + ' Температура от {} до {}°C.\n'
+                + WIND + ' {} (до {} м/с).')
+SUN_TEMPLATE = SUNRISE + ' Время рассвета: {} \n' + SUNSET + ' Время заката: {}'
+
+# время (unix), код погоды, температура и ощущаемая температура в сотых °C,
+# влажность в %, скорость ветра в сотых м/с, номер описания погоды
+SLOT = struct.Struct('<IHhhBHB')
+HEADER = struct.Struct('<2sBiqqH')
+MAGIC = b'WF'
+VERSION = 1
+
+Slot = namedtuple('Slot', 'dt code temp feels_like humidity wind_speed description')
+
+
+class WeatherForecast:
+    """Компактный прогноз для одного местоположения.
+    Интервалы прогноза хранятся упакованными в bytes по SLOT.size байт,
+    описания погоды - одним списком без повторов. Из одного прогноза формируются
+    сообщения на 3 часа, на сутки и на 5 дней в момент отправки."""
+
+    __slots__ = ('city', 'timezone', 'sunrise', 'sunset', 'descriptions', 'slots')
+
+    def __init__(self,
+                 city: str,
+                 timezone: int,
+                 sunrise: int,
+                 sunset: int,
+                 descriptions: List[str],
+                 slots: bytes) -> None:
+        self.city = city
+        self.timezone = timezone
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.descriptions = descriptions
+        self.slots = slots
+
+    def __len__(self) -> int:
+        return len(self.slots) // SLOT.size
+
+    def __iter__(self) -> Iterator[Slot]:
+        descriptions = self.descriptions
+        for dt, code, temp, feels_like, humidity, wind_speed, description in SLOT.iter_unpack(self.slots):
+            yield Slot(dt, code, temp / 100, feels_like / 100, humidity, wind_speed / 100, descriptions[description])
+
+    @classmethod
+    def from_response(cls, response: dict) -> 'WeatherForecast':
+        """Создает прогноз из ответа API. Если в ответе нет нужных ключей - KeyError."""
+        city = response.get('city', {})
+        descriptions = []
+        indexes = {}
+        slots = bytearray()
+        for data in response['list']:
+            weather = data['weather'][0]
+            description = weather['description']
+            if description not in indexes:
+                indexes[description] = len(descriptions)
+                descriptions.append(description)
+            slots += SLOT.pack(int(data['dt']),
+                               int(weather['id']),
+                               round(float(data['main']['temp']) * 100),
+                               round(float(data['main']['feels_like']) * 100),
+                               round(float(data['main']['humidity'])),
+                               round(float(data['wind']['speed']) * 100),
+                               indexes[description])
+        return cls(city=city.get('name') or 'Не определено',
+                   timezone=int(city.get('timezone') or 0),
+                   sunrise=int(city.get('sunrise') or 0),
+                   sunset=int(city.get('sunset') or 0),
+                   descriptions=descriptions,
+                   slots=bytes(slots))
+
+    def to_bytes(self) -> bytes:
+        parts = [HEADER.pack(MAGIC, VERSION, self.timezone, self.sunrise, self.sunset, len(self.descriptions)),
+                 _pack_str(self.city)]
+        parts.extend(_pack_str(description) for description in self.descriptions)
+        parts.append(self.slots)
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'WeatherForecast':
+        """Восстанавливает прогноз из to_bytes. Если данные в другом формате - ValueError."""
+        try:
+            magic, version, timezone, sunrise, sunset, count = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Неизвестный формат прогноза.')
+            offset = HEADER.size
+            city, offset = _unpack_str(data, offset)
+            descriptions = []
+            for _ in range(count):
+                description, offset = _unpack_str(data, offset)
+                descriptions.append(description)
+        except struct.error as error:
+            raise ValueError(f'Поврежденный прогноз: {error}.')
+        slots = data[offset:]
+        if len(slots) % SLOT.size:
+            raise ValueError('Поврежденный прогноз.')
+        return cls(city, timezone, sunrise, sunset, descriptions, slots)
+
+
+def _pack_str(value: str) -> bytes:
+    encoded = value.encode()
+    return struct.pack('<H', len(encoded)) + encoded
+
+
+def _unpack_str(data: bytes, offset: int):
+    (length,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode(), offset + length
+
+
+def wind_text(wind_speed: float) -> str:
+    return WIND_TEXTS[bisect_left(WIND_LIMITS, wind_speed)]
+
+
+def weather_emoji(code: int) -> str:
+    emoji = EMOJI.get(code)
+    if not emoji:
+        logger.error('Не удалось получить emoji для кода %s.', code)
+        emoji = UNKNOWN
+    return emoji
+
+
+def day_text(day: int, local: int) -> str:
+    """Подпись дня: day - номер дня относительно сегодняшнего, local - время в часовом поясе местоположения."""
+    if day == 0:
+        return 'Сегодня'
+    if day == 1:
+        return 'Завтра'
+    date = EPOCH + timedelta(seconds=local)
+    return f'{date.strftime("%d.%m")}, {WEEKDAYS[date.weekday()]}'
+
+
+def local_time(timestamp: int, timezone: int) -> str:
+    return TIMES[(timestamp + timezone) % DAY_SECONDS // 60]
+
+
+def render_forecast(forecast: WeatherForecast, horizon: str = HORIZON_24H, now: Optional[datetime] = None) -> str:
+    """Формирует сообщение с погодой из прогноза на момент now (по умолчанию - текущее время UTC).
+    Уже прошедшие интервалы прогноза пропускаются."""
+    now = now or datetime.utcnow()
+    timezone = forecast.timezone
+    now_timestamp = int((now - EPOCH).total_seconds())
+    today = (now_timestamp + timezone) // DAY_SECONDS
+    start = now_timestamp - SLOT_SECONDS
+    slots = [slot for slot in SLOT.iter_unpack(forecast.slots) if slot[0] > start]
+    descriptions = [description.capitalize() for description in forecast.descriptions]
+
+    parts = [HEADER_TEMPLATE.format(forecast.city)]
+    if horizon == HORIZON_5D:
+        parts.append(_render_days(slots, descriptions, timezone, today))
+        return ''.join(parts)
+
+    for dt, code, temp, feels_like, humidity, wind_speed, description in slots[:1 if horizon == HORIZON_3H else 8]:
+        local = dt + timezone
+        wind_speed /= 100
+        parts.append(SLOT_TEMPLATE.format(day_text(local // DAY_SECONDS - today, local),
+                                          TIMES[local % DAY_SECONDS // 60],
+                                          weather_emoji(code),
+                                          descriptions[description],
+                                          round(temp / 100),
+                                          round(feels_like / 100),
+                                          humidity,
+                                          wind_text(wind_speed),
+                                          wind_speed))
+
+    if forecast.sunrise and forecast.sunset:
+        parts.append(SUN_TEMPLATE.format(local_time(forecast.sunrise, timezone), local_time(forecast.sunset, timezone)))
+    return ''.join(parts)
+
+
+def _render_days(slots: List[tuple], descriptions: List[str], timezone: int, today: int) -> str:
+    """Сводка по дням: погода ближе всего к полудню, минимальная и максимальная температура, сильнейший ветер."""
+    days = {}
+    for slot in slots:
+        days.setdefault((slot[0] + timezone) // DAY_SECONDS, []).append(slot)
+
+    parts = []
+    for day, day_slots in days.items():
+        midday = min(day_slots, key=lambda slot: abs((slot[0] + timezone) % DAY_SECONDS // 3600 - 12))
+        temps = [slot[2] for slot in day_slots]
+        wind_speed = max(slot[5] for slot in day_slots) / 100
+        parts.append(DAY_TEMPLATE.format(day_text(day - today, midday[0] + timezone),
+                                         weather_emoji(midday[1]),
+                                         descriptions[midday[6]],
+                                         round(min(temps) / 100),
+                                         round(max(temps) / 100),
+                                         wind_text(wind_speed),
+                                         wind_speed))
+    return '\n\n'.join(parts)
@@ -0,0 +1,202 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import Forecast
+from forecast import WeatherForecast
+from geocoder import Geocoder
+from metrics import DB_SECONDS
+from repository import session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastCache:
+    """Кэш прогнозов погоды (WeatherForecast), общий для всех пользователей одного квадрата координат.
+    Записи хранятся в памяти с вытеснением давно не использованных (LRU)
+    и дублируются в таблицу forecasts, чтобы кэш переживал перезапуск бота.
+    Если задан geocoder, прогноз общий для всех пользователей одного города.
+    Прогнозы, устаревшие не больше чем на stale_ttl секунд, хранятся, чтобы показывать их, пока идет обновление.
+    Устаревший прогноз перечитывается из базы (его мог обновить другой процесс) не чаще раза в reload_interval
+    секунд для квадрата, чтобы выдача устаревших прогнозов не обращалась к базе на каждый запрос."""
+
+    def __init__(self,
+                 ttl: int = 3600,
+                 maxsize: int = 10000,
+                 precision: int = 1,
+                 geocoder: Optional[Geocoder] = None,
+                 stale_ttl: int = 0,
+                 reload_interval: float = 30) -> None:
+        self.ttl = timedelta(seconds=ttl)
+        self.stale_ttl = timedelta(seconds=stale_ttl)
+        self.maxsize = maxsize
+        self.precision = precision
+        self.geocoder = geocoder
+        self.reload_interval = reload_interval
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Координаты городов, ключи которых выдал tile
+        self._cities = {}
+        # Время последнего чтения квадрата из базы, time.monotonic()
+        self._reloaded = {}
+        self._lock = threading.Lock()
+
+    def tile(self, latitude: float, longitude: float) -> Tuple[str, float, float]:
+        """Возвращает ключ квадрата координат и координаты его центра.
+        При precision=1 сторона квадрата около 11 км, это все еще мельче сетки прогноза провайдера.
+        Если задан geocoder и рядом есть город, возвращает ключ города и его координаты."""
+        if self.geocoder:
+            city = self.geocoder.lookup(latitude, longitude)
+            if city:
+                key = f'city:{city.id}'
+                self._cities[key] = (city.latitude, city.longitude)
+                return key, city.latitude, city.longitude
+        latitude = round(latitude, self.precision) + 0.0
+        longitude = round(longitude, self.precision) + 0.0
+        key = f'{latitude:.{self.precision}f}:{longitude:.{self.precision}f}'
+        return key, latitude, longitude
+
+    def lookup(self, key: str) -> Tuple[Optional[WeatherForecast], bool]:
+        """Возвращает прогноз для квадрата и признак того, что он актуален.
+        Устаревший не больше чем на stale_ttl прогноз тоже возвращается, с признаком False, его можно
+        показать пользователю, пока прогноз обновляется в фоне. Если актуального прогноза нет в памяти,
+        то ищет его в базе данных."""
+        now = datetime.now()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], True
+        if self._reload_due(key, entry):
+            entry = self._reload(key, entry, now)
+        with self._lock:
+            if entry and now - entry[0] <= self.ttl:
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+            if entry and now - entry[0] <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                return entry[1], False
+        return None, False
+
+    def updated(self, key: str) -> Optional[datetime]:
+        """Время получения последнего прогноза для квадрата, с учетом обновленных другими процессами."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if self._reload_due(key, entry):
+            entry = self._reload(key, entry, datetime.now())
+        return entry[0] if entry else None
+
+    def nearest(self,
+                latitude: float,
+                longitude: float,
+                max_distance: float) -> Optional[Tuple[WeatherForecast, datetime, float]]:
+        """Ближайший к координатам прогноз в памяти любой давности, но не дальше max_distance км.
+        Возвращает прогноз, время его получения и расстояние до центра его квадрата в км."""
+        with self._lock:
+            entries = list(self._entries.items())
+        scale = math.cos(math.radians(latitude))
+        best = None
+        for key, (updated, forecast) in entries:
+            location = self._location(key)
+            if not location:
+                continue
+            distance = 111.2 * math.hypot(location[0] - latitude, (location[1] - longitude) * scale)
+            if distance <= max_distance and (best is None or distance < best[2]):
+                best = (forecast, updated, distance)
+        return best
+
+    def put(self, key: str, forecast: WeatherForecast) -> None:
+        """Сохраняет прогноз для квадрата в памяти и в базе данных.
+        Ошибка записи в базу только записывается в лог: прогноз уже получен и остается в памяти."""
+        updated = datetime.now()
+        with self._lock:
+            self._store(key, updated, forecast)
+        try:
+            with DB_SECONDS.time('forecast_put'), session_scope() as session:
+                session.merge(Forecast(tile=key, updated=updated, payload=forecast.to_bytes()))
+        except SQLAlchemyError as error:
+            logger.error('Не удалось сохранить прогноз для квадрата %s в базу данных. Ошибка: %s.', key, error)
+
+    def load(self) -> None:
+        """Загружает в память актуальные прогнозы из базы данных, вызывается при запуске бота."""
+        since = datetime.now() - self.ttl - self.stale_ttl
+        with session_scope() as session:
+            rows = (session.query(Forecast)
+                    .filter(Forecast.updated >= since)
+                    .order_by(Forecast.updated.desc())
+                    .limit(self.maxsize)
+                    .all())
+        loaded = 0
+        with self._lock:
+            for row in reversed(rows):
+                forecast = self._decode(row)
+                if forecast:
+                    self._store(row.tile, row.updated, forecast)
+                    loaded += 1
+        logger.info('Из базы данных загружено прогнозов: %s.', loaded)
+
+    def stats(self) -> dict:
+        """Возвращает счетчики попаданий, промахов, выдачи устаревших прогнозов и вытеснений."""
+        with self._lock:
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stale_hits': self.stale_hits,
+                    'evictions': self.evictions}
+
+    def _reload_due(self, key: str, entry: Optional[tuple]) -> bool:
+        """Нужно ли читать квадрат из базы: всегда, если его нет в памяти, иначе не чаще раза в reload_interval."""
+        if entry is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now - self._reloaded.get(key, -math.inf) < self.reload_interval:
+                return False
+            self._reloaded[key] = now
+        return True
+
+    def _reload(self, key: str, entry: Optional[tuple], now: datetime) -> Optional[tuple]:
+        """Загружает прогноз из базы данных, если он новее записи entry из памяти."""
+        with DB_SECONDS.time('forecast_get'), session_scope() as session:
+            row = session.get(Forecast, key)
+        if not row or (entry and row.updated <= entry[0]) or now - row.updated > self.ttl + self.stale_ttl:
+            return entry
+        forecast = self._decode(row)
+        if not forecast:
+            return entry
+        with self._lock:
+            self._store(key, row.updated, forecast)
+        return row.updated, forecast
+
+    def _location(self, key: str) -> Optional[Tuple[float, float]]:
+        if key.startswith('city:'):
+            return self._cities.get(key)
+        latitude, longitude = key.split(':')
+        return float(latitude), float(longitude)
+
+    @staticmethod
+    def _decode(row: Forecast) -> Optional[WeatherForecast]:
+        try:
+            return WeatherForecast.from_bytes(row.payload)
+        except ValueError as error:
+            logger.warning('Прогноз для квадрата %s в базе данных в неизвестном формате: %s.', row.tile, error)
+            return None
+
+    def _store(self, key: str, updated: datetime, forecast: WeatherForecast) -> None:
+        self._entries[key] = (updated, forecast)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            evicted, _ = self._entries.popitem(last=False)
+            self._reloaded.pop(evicted, None)
+            self.evictions += 1
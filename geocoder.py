@@ -0,0 +1,158 @@
+import csv
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+GEOCODER_CITIES = os.getenv('GEOCODER_CITIES', str(Path(__file__).parent / 'data' / 'cities.csv'))
+GEOCODER_INDEX = os.getenv('GEOCODER_INDEX', 'cities.idx')
+GEOCODER_MAX_DISTANCE = float(os.getenv('GEOCODER_MAX_DISTANCE', 50))
+
+EARTH_RADIUS = 6371.0
+MAGIC = b'GEO1'
+VERSION = 1
+# Заголовок индекса: сигнатура, версия, число городов
+HEADER = struct.Struct('<4sHI')
+# Узел KD-дерева: точка на единичной сфере и номер города
+NODE = struct.Struct('<fffI')
+# Город: id, широта, долгота, смещение и длина названия
+CITY = struct.Struct('<IffIH')
+
+logger = logging.getLogger(__name__)
+
+
+class City(NamedTuple):
+    id: int
+    name: str
+    latitude: float
+    longitude: float
+
+
+def to_vector(latitude: float, longitude: float) -> Tuple[float, float, float]:
+    """Точка на единичной сфере: расстояние между такими точками монотонно зависит от расстояния по поверхности."""
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def read_cities(path: str) -> List[City]:
+    with open(path, encoding='utf-8', newline='') as file:
+        return [City(int(row['id']), row['name'], float(row['latitude']), float(row['longitude']))
+                for row in csv.DictReader(file)]
+
+
+def build_index(cities: List[City], path: str) -> None:
+    """Записывает индекс городов в файл path.
+    KD-дерево хранится неявно: в каждом диапазоне узлов корень - средний узел, левее него - левое поддерево,
+    правее - правое, поэтому ссылки на потомков не нужны. Файл записывается во временный и затем
+    заменяет старый, поэтому процессы, которые уже читают старый индекс, не затрагиваются."""
+    nodes = [(*to_vector(city.latitude, city.longitude), index) for index, city in enumerate(cities)]
+
+    def arrange(lo: int, hi: int, depth: int) -> None:
+        if hi - lo <= 1:
+            return
+        nodes[lo:hi] = sorted(nodes[lo:hi], key=lambda node: node[depth % 3])
+        middle = (lo + hi) // 2
+        arrange(lo, middle, depth + 1)
+        arrange(middle + 1, hi, depth + 1)
+
+    arrange(0, len(nodes), 0)
+    names = bytearray()
+    table = bytearray()
+    for city in cities:
+        name = city.name.encode('utf-8')
+        table += CITY.pack(city.id, city.latitude, city.longitude, len(names), len(name))
+        names += name
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(cities)))
+        for node in nodes:
+            file.write(NODE.pack(*node))
+        file.write(table)
+        file.write(names)
+    os.replace(temporary, path)
+    logger.info('Построен индекс городов %s: %s городов.', path, len(cities))
+
+
+class Geocoder:
+    """Определение ближайшего города по координатам без обращения к внешним API.
+    Индекс строится из cities (CSV: id, name, latitude, longitude) в файл index при первом обращении
+    и читается через mmap только для чтения, поэтому процессы бота используют одну копию файла в памяти.
+    Если ближайший город дальше max_distance км, город не определяется."""
+
+    def __init__(self,
+                 cities: str = GEOCODER_CITIES,
+                 index: str = GEOCODER_INDEX,
+                 max_distance: float = GEOCODER_MAX_DISTANCE) -> None:
+        self.cities = cities
+        self.index = index
+        # Максимальное расстояние как квадрат хорды единичной сферы
+        self.max_chord = (2 * math.sin(min(max_distance / EARTH_RADIUS, math.pi) / 2)) ** 2
+        self.count = 0
+        self._data: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def prepare(self) -> None:
+        """Строит индекс, если его нет или он старше файла городов."""
+        if (not os.path.exists(self.index)
+                or os.path.getmtime(self.index) < os.path.getmtime(self.cities)):
+            build_index(read_cities(self.cities), self.index)
+
+    def load(self) -> mmap.mmap:
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self.prepare()
+                    with open(self.index, 'rb') as file:
+                        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    magic, version, self.count = HEADER.unpack_from(data)
+                    if magic != MAGIC or version != VERSION:
+                        data.close()
+                        raise ValueError(f'неизвестный формат индекса городов {self.index}')
+                    self._data = data
+        return self._data
+
+    def lookup(self, latitude: float, longitude: float) -> Optional[City]:
+        """Ближайший к координатам город либо None."""
+        try:
+            data = self.load()
+        except (OSError, ValueError) as error:
+            logger.error('Не удалось загрузить индекс городов. Ошибка: %s.', error)
+            return None
+        index = self._nearest(data, to_vector(latitude, longitude))
+        return None if index is None else self._city(data, index)
+
+    def _nearest(self, data: mmap.mmap, point: Tuple[float, float, float]) -> Optional[int]:
+        best, best_distance = None, self.max_chord
+        unpack_from, size, offset = NODE.unpack_from, NODE.size, HEADER.size
+        # Диапазон узлов, глубина и квадрат расстояния до разделяющей плоскости
+        stack = [(0, self.count, 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or bound > best_distance:
+                continue
+            middle = (lo + hi) // 2
+            x, y, z, city = unpack_from(data, offset + middle * size)
+            distance = (x - point[0]) ** 2 + (y - point[1]) ** 2 + (z - point[2]) ** 2
+            if distance <= best_distance:
+                best, best_distance = city, distance
+            axis = depth % 3
+            diff = point[axis] - (x, y, z)[axis]
+            near, far = ((lo, middle), (middle + 1, hi)) if diff < 0 else ((middle + 1, hi), (lo, middle))
+            stack.append((*far, depth + 1, diff * diff))
+            stack.append((*near, depth + 1, 0.0))
+        return best
+
+    def _city(self, data: mmap.mmap, index: int) -> City:
+        tables = HEADER.size + self.count * NODE.size
+        city_id, latitude, longitude, name_offset, name_length = CITY.unpack_from(data, tables + index * CITY.size)
+        names = tables + self.count * CITY.size + name_offset
+        return City(city_id, data[names:names + name_length].decode('utf-8'), round(latitude, 4), round(longitude, 4))
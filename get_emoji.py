@@ -56,17 +56,28 @@ EMOJI_CODE = {200: 'U+26C8',
               804: 'U+2601'}
 
 
-def get_emoji(code: int) -> Optional[str]:
-    emoji_code = EMOJI_CODE.get(code)
-    if emoji_code:
-        return get_emoji_str(emoji_code)
-    return None
-
-
 def get_emoji_str(emoji_code: str) -> str:
     return chr(int(emoji_code.lstrip("U+").zfill(8), 16))
 
 
+# Таблица эмоджи для кодов погоды, строится один раз при импорте
+EMOJI = {code: get_emoji_str(emoji_code) for code, emoji_code in EMOJI_CODE.items()}
+
+CITY = get_emoji_str('U+1F3D9')
+CLOCK = get_emoji_str('U+1F558')
+CALENDAR = get_emoji_str('U+1F4C5')
+THERMOMETER = get_emoji_str('U+1F321')
+DROPLET = get_emoji_str('U+1F4A7')
+WIND = get_emoji_str('U+1F4A8')
+SUNRISE = get_emoji_str('U+1F31E')
+SUNSET = get_emoji_str('U+1F31A')
+UNKNOWN = get_emoji_str('U+2753')
+
+
+def get_emoji(code: int) -> Optional[str]:
+    return EMOJI.get(code)
+
+
 if __name__ == '__main__':
     for code in EMOJI_CODE:
         print(get_emoji(code))
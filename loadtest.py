@@ -0,0 +1,272 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Queue
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+TOKEN = '123456:LOADTEST'
+WEATHER_PATH = '/data/2.5/forecast'
+WEATHER_BUTTONS = ('Получить погоду', 'Погода на 3 часа', 'Прогноз на 5 дней')
+# Центры скоплений пользователей: название, широта, долгота, доля пользователей
+CITIES = (('Москва', 55.7522, 37.6156, 0.35),
+          ('Санкт-Петербург', 59.9386, 30.3141, 0.15),
+          ('Новосибирск', 55.0415, 82.9346, 0.08),
+          ('Екатеринбург', 56.8519, 60.6122, 0.08),
+          ('Казань', 55.7887, 49.1221, 0.07),
+          ('Нижний Новгород', 56.3287, 44.002, 0.07),
+          ('Краснодар', 45.0448, 38.976, 0.07),
+          ('Самара', 53.2001, 50.15, 0.06),
+          ('Владивосток', 43.1056, 131.8735, 0.04),
+          ('Мурманск', 68.9792, 33.0925, 0.03))
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Локальная замена внешнего API с задержкой ответа latency секунд и долей ошибок error_rate."""
+
+    daemon_threads = True
+
+    def __init__(self, handler: type, latency: float, error_rate: float, seed: int) -> None:
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self) -> 'FakeServer':
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def call(self, name: str) -> bool:
+        """Учитывает вызов и ждет latency. Возвращает False, если вызов должен завершиться ошибкой."""
+        with self._lock:
+            failed = self.random.random() < self.error_rate
+            self.calls[f'{name} error' if failed else name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return not failed
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeServer
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status: int, data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class TelegramHandler(FakeHandler):
+    """Bot API: на sendMessage отвечает отправленным сообщением, на ошибку - 500 как Telegram."""
+
+    def do_POST(self) -> None:
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.server.call(method):
+            self.reply(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            return
+        data = json.loads(body or b'{}')
+        result = {'message_id': 1,
+                  'date': int(time.time()),
+                  'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+                  'text': data.get('text', '')}
+        self.reply(200, {'ok': True, 'result': result})
+
+
+class WeatherHandler(FakeHandler):
+    """API прогноза OpenWeatherMap: отдает записанные ответы из fixtures, сдвинутые на текущее время."""
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path != WEATHER_PATH:
+            self.reply(404, {'cod': '404', 'message': 'not found'})
+            return
+        if not self.server.call('forecast'):
+            self.reply(503, {'cod': 503, 'message': 'Service Unavailable'})
+            return
+        query = parse_qs(url.query)
+        responses = self.server.responses
+        key = zlib.crc32(f"{query.get('lat', [''])[0]}:{query.get('lon', [''])[0]}".encode())
+        self.reply(200, responses[key % len(responses)])
+
+
+def replay_responses(now: datetime) -> List[dict]:
+    """Записанные ответы API, в которых время прогнозов сдвинуто так, что первый прогноз - на ближайшие 3 часа."""
+    start = int(now.timestamp()) // 10800 * 10800
+    responses = []
+    for path in sorted(FIXTURES.glob('*.json')):
+        response = json.loads(path.read_text(encoding='utf-8'))
+        shift = start - response['list'][0]['dt']
+        for item in response['list']:
+            item['dt'] += shift
+            item['dt_txt'] = datetime.fromtimestamp(item['dt'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        response['city']['sunrise'] += shift
+        response['city']['sunset'] += shift
+        responses.append(response)
+    return responses
+
+
+def population(users: int, spread: float, seed: int) -> List[Tuple[int, float, float]]:
+    """Синтетические пользователи: (chat_id, широта, долгота).
+    Пользователи распределены по городам CITIES пропорционально их доле, вокруг центра города
+    по нормальному закону со стандартным отклонением spread км."""
+    rng = random.Random(seed)
+    weights = [city[3] for city in CITIES]
+    result = []
+    for number in range(users):
+        _, latitude, longitude, _ = rng.choices(CITIES, weights)[0]
+        latitude += rng.gauss(0, spread / 111)
+        longitude += rng.gauss(0, spread / (111 * math.cos(math.radians(latitude))))
+        result.append((1000000 + number, round(latitude, 6), round(longitude, 6)))
+    return result
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def configure(args: argparse.Namespace, workdir: str, weather: FakeServer) -> None:
+    """Переменные окружения для main: их нужно задать до импорта main.
+    Размеры пулов соединений по умолчанию равны числу одновременно обрабатываемых пользователей,
+    квота запросов к API по умолчанию не ограничена."""
+    os.environ.update({'TELEGRAM_TOKEN': TOKEN,
+                       'API_KEY': 'loadtest',
+                       'URL_WEATHER_API': weather.url + WEATHER_PATH,
+                       'DATABASE_URL': f'sqlite:///{Path(workdir) / "loadtest.sqlite"}',
+                       'LOG_FILE': str(Path(workdir) / 'loadtest.log'),
+                       'LOG_LEVEL': args.log_level})
+    os.environ.setdefault('DATABASE_POOL_SIZE', str(args.concurrency))
+    os.environ.setdefault('WEATHER_POOL_SIZE', str(args.concurrency))
+    os.environ.setdefault('API_QUOTA_PER_MINUTE', '0')
+    os.environ.setdefault('API_QUOTA_PER_DAY', '0')
+
+
+def run(args: argparse.Namespace, workdir: str) -> Dict[str, object]:
+    now = datetime.now()
+    telegram = FakeServer(TelegramHandler, args.telegram_latency, args.telegram_errors, args.seed).start()
+    weather = FakeServer(WeatherHandler, args.weather_latency, args.weather_errors, args.seed)
+    weather.responses = replay_responses(now)
+    weather.start()
+    configure(args, workdir, weather)
+
+    from sqlalchemy import event
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher
+    from telegram.utils.request import Request
+
+    import main as bot
+    from database import engine
+
+    writes = Counter()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_writes(conn, cursor, statement, parameters, context, executemany) -> None:
+        operation = statement.lstrip().split(' ', 1)[0].upper()
+        if operation in ('INSERT', 'UPDATE', 'DELETE'):
+            writes[operation] += 1
+            writes['rows'] += len(parameters) if executemany else 1
+
+    bot.user_registry.load()
+    bot.last_message_writer.start()
+    telegram_bot = Bot(token=TOKEN, base_url=f'{telegram.url}/bot',
+                       request=Request(con_pool_size=args.concurrency + 4))
+    dispatcher = Dispatcher(telegram_bot, Queue(), workers=1)
+    bot.add_handlers(dispatcher)
+
+    users = population(args.users, args.spread, args.seed)
+    rng = random.Random(args.seed)
+    update_ids = iter(range(1, sys.maxsize))
+    scenarios = []
+    for chat_id, latitude, longitude in users:
+        chat = {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}'}
+        sender = {'id': chat_id, 'is_bot': False, 'first_name': 'Load'}
+        messages = [{'location': {'latitude': latitude, 'longitude': longitude}}]
+        messages += [{'text': rng.choice(WEATHER_BUTTONS)} for _ in range(args.requests)]
+        scenarios.append([{'update_id': next(update_ids),
+                           'message': {'message_id': 1, 'date': int(now.timestamp()), 'chat': chat, 'from': sender,
+                                       **message}} for message in messages])
+
+    def play(scenario: List[dict]) -> List[float]:
+        """Обновления одного пользователя обрабатываются по порядку, как в боте."""
+        latencies = []
+        for data in scenario:
+            start = time.perf_counter()
+            dispatcher.process_update(Update.de_json(data, telegram_bot))
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='loadtest') as executor:
+        latencies = sorted(latency for result in executor.map(play, scenarios) for latency in result)
+    elapsed = time.perf_counter() - start
+    bot.last_message_writer.stop()
+    dispatcher.stop()
+
+    tiles = {bot.forecast_cache.tile(latitude, longitude)[0] for _, latitude, longitude in users}
+    return {'users': len(users),
+            'updates': len(latencies),
+            'tiles': len(tiles),
+            'seconds': round(elapsed, 3),
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'weather_calls': dict(weather.calls),
+            'telegram_calls': dict(telegram.calls),
+            'db_writes': dict(writes),
+            'cache': bot.forecast_cache.stats()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест обработчиков бота без доступа к сети: '
+                                                 'Telegram и API погоды заменены локальными серверами.')
+    parser.add_argument('--users', type=int, default=1000, help='число синтетических пользователей')
+    parser.add_argument('--requests', type=int, default=5, help='запросов погоды от каждого пользователя')
+    parser.add_argument('--concurrency', type=int, default=32, help='пользователей, обрабатываемых одновременно')
+    parser.add_argument('--spread', type=float, default=10, help='разброс пользователей вокруг центра города, км')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='задержка ответа Telegram, с')
+    parser.add_argument('--telegram-errors', type=float, default=0.0, help='доля ошибок Telegram')
+    parser.add_argument('--weather-latency', type=float, default=0.2, help='задержка ответа API погоды, с')
+    parser.add_argument('--weather-errors', type=float, default=0.0, help='доля ошибок API погоды')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора случайных чисел')
+    parser.add_argument('--log-level', default='WARNING', help='уровень лога бота')
+    parser.add_argument('--save', type=Path, help='сохранить отчет в json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='loadtest') as workdir:
+        report = run(args, workdir)
+    for name, value in report.items():
+        print(f'{name:<16} {value}')
+    if args.save:
+        args.save.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import atexit
+import json
+import logging
+import os
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Full, Queue
+from typing import Any, Optional
+
+LOG_FILE = os.getenv('LOG_FILE', 'main.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 2 ** 20))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_PAYLOAD_LIMIT = int(os.getenv('LOG_PAYLOAD_LIMIT', 1000))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+
+# Библиотеки, которые пишут в лог только предупреждения и ошибки
+QUIET_LOGGERS = ('telegram', 'apscheduler', 'urllib3')
+
+_listener: Optional[QueueListener] = None
+_handler: Optional['DeferredQueueHandler'] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Записывает каждое сообщение лога одной строкой JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'function': record.funcName,
+                'line': record.lineno,
+                'message': record.getMessage()}
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Передает записи лога в очередь фонового потока без форматирования.
+    Сообщение собирается из аргументов уже в фоновом потоке, поэтому аргументы не должны меняться
+    после вызова логгера. Если очередь заполнена, запись отбрасывается, а не блокирует обработчик.
+    Число отброшенных записей хранится в dropped, а когда в очереди снова есть место,
+    в лог пишется предупреждение о том, сколько записей было отброшено."""
+
+    def __init__(self, queue: Queue) -> None:
+        super().__init__(queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # Вызывается под блокировкой обработчика, поэтому счетчики не нужно защищать отдельно
+        try:
+            if self.dropped > self.reported:
+                self.queue.put_nowait(self._dropped_record(self.dropped - self.reported))
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def _dropped_record(self, count: int) -> logging.LogRecord:
+        return logging.getLogger(__name__).makeRecord(
+            __name__, logging.WARNING, __file__, 0,
+            'Очередь лога была заполнена, отброшено записей: %s, всего: %s.', (count, self.dropped), None)
+
+
+class Payload:
+    """Большой объект для лога (например ответ API): сериализуется и обрезается до limit символов
+    только при записи в файл, в фоновом потоке."""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value: Any, limit: int = LOG_PAYLOAD_LIMIT) -> None:
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = json.dumps(self.value, ensure_ascii=False, default=str)
+        if len(text) > self.limit:
+            return f'{text[:self.limit]}... (всего {len(text)} символов)'
+        return text
+
+
+def payload(value: Any) -> Payload:
+    return Payload(value)
+
+
+def sample_payload(logger: logging.Logger) -> bool:
+    """Нужно ли записать полный ответ API: только на уровне DEBUG и только для доли LOG_PAYLOAD_SAMPLE_RATE вызовов."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def dropped_records() -> int:
+    """Сколько записей лога отброшено из-за заполненной очереди с момента запуска."""
+    return _handler.dropped if _handler else 0
+
+
+def setup_logging() -> None:
+    """Настраивает запись лога всех модулей бота в main.log через фоновый поток.
+    Файл ротируется по размеру LOG_MAX_BYTES, хранится LOG_BACKUP_COUNT старых файлов."""
+    global _listener, _handler
+    if _listener:
+        return
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                       encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    queue = Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    _handler = DeferredQueueHandler(queue)
+    root.addHandler(_handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    _listener = QueueListener(queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,38 +1,123 @@
 import logging
 import os
 import sys
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime, time, timedelta
+from functools import partial
+from typing import Optional, Tuple
 
-import requests
+import pytz
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
 from telegram import TelegramError, ReplyKeyboardMarkup, KeyboardButton
 from telegram import update as update_type
-from telegram.ext import Updater, Filters, MessageHandler
+from telegram.ext import Dispatcher, Updater, Filters, MessageHandler
 from telegram.ext import callbackcontext
 
-from database import engine, User
-from get_emoji import get_emoji, get_emoji_str
+from broadcast import Broadcaster
+from database import User
+from delivery import DeliveryQueue
+from forecast import HORIZON_3H, HORIZON_5D, HORIZON_24H, WeatherForecast, render_forecast
+from forecast_cache import ForecastCache
+from geocoder import Geocoder
+import metrics
+from log_config import dropped_records, payload, sample_payload, setup_logging
+from metrics import HANDLER_SECONDS, PARSE_SECONDS, RENDER_SECONDS, SEND_SECONDS, TELEGRAM_ERRORS, timed
+from quota import BACKGROUND, INTERACTIVE, QuotaManager
+from refresher import ForecastRefresher
+from repository import LastMessageWriter, SubscriptionRepository, UserRepository, with_session
+from user_registry import UserRecord, UserRegistry
+from single_flight import SingleFlight
+from weather_client import CircuitBreaker, WeatherClient
 
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 API_KEY = os.getenv('API_KEY')
 ADMIN_ID = 177396046
 
-URL_WEATHER_API = 'https://api.openweathermap.org/data/2.5/forecast'
-
+URL_WEATHER_API = os.getenv('URL_WEATHER_API', 'https://api.openweathermap.org/data/2.5/forecast')
+FORECAST_CACHE_TTL = int(os.getenv('FORECAST_CACHE_TTL', 3600))
+FORECAST_STALE_TTL = int(os.getenv('FORECAST_STALE_TTL', 10800))
+FORECAST_RELOAD_INTERVAL = float(os.getenv('FORECAST_RELOAD_INTERVAL', 30))
+FORECAST_CACHE_SIZE = int(os.getenv('FORECAST_CACHE_SIZE', 10000))
+FORECAST_TILE_PRECISION = int(os.getenv('FORECAST_TILE_PRECISION', 1))
+FORECAST_FAILURE_TTL = float(os.getenv('FORECAST_FAILURE_TTL', 10))
+# Ключ общего прогноза: tile - квадрат координат, city - ближайший город
+FORECAST_KEY = os.getenv('FORECAST_KEY', 'tile')
+WEATHER_CONNECT_TIMEOUT = float(os.getenv('WEATHER_CONNECT_TIMEOUT', 3.05))
+WEATHER_READ_TIMEOUT = float(os.getenv('WEATHER_READ_TIMEOUT', 10))
+WEATHER_RETRIES = int(os.getenv('WEATHER_RETRIES', 2))
+WEATHER_POOL_SIZE = int(os.getenv('WEATHER_POOL_SIZE', 20))
+WEATHER_BREAKER_THRESHOLD = int(os.getenv('WEATHER_BREAKER_THRESHOLD', 5))
+WEATHER_BREAKER_RESET = float(os.getenv('WEATHER_BREAKER_RESET', 30))
+API_QUOTA_PER_MINUTE = int(os.getenv('API_QUOTA_PER_MINUTE', 60))
+API_QUOTA_PER_DAY = int(os.getenv('API_QUOTA_PER_DAY', 30000))
+API_QUOTA_RESERVE = float(os.getenv('API_QUOTA_RESERVE', 0.2))
+API_QUOTA_WAIT = float(os.getenv('API_QUOTA_WAIT', 1))
+QUOTA_FALLBACK_DISTANCE = float(os.getenv('QUOTA_FALLBACK_DISTANCE', 50))
+REFRESH_TOP = int(os.getenv('REFRESH_TOP', 100))
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', 60))
+REFRESH_LEAD = float(os.getenv('REFRESH_LEAD', 600))
+REFRESH_WORKERS = int(os.getenv('REFRESH_WORKERS', 4))
+LAST_MESSAGE_FLUSH_INTERVAL = float(os.getenv('LAST_MESSAGE_FLUSH_INTERVAL', 1))
+BROADCAST_TIME = time.fromisoformat(os.getenv('BROADCAST_TIME', '07:00')).replace(
+    tzinfo=pytz.timezone(os.getenv('BROADCAST_TIMEZONE', 'Europe/Moscow')))
+BROADCAST_PREFETCH_MINUTES = int(os.getenv('BROADCAST_PREFETCH_MINUTES', 10))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 16))
+DELIVERY_RATE = float(os.getenv('DELIVERY_RATE', 25))
+DELIVERY_CHAT_INTERVAL = float(os.getenv('DELIVERY_CHAT_INTERVAL', 1))
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 8))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_DUMP_FILE = os.getenv('METRICS_DUMP_FILE')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', 60))
+
+setup_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - '
-                              '%(funcName)s - %(lineno)d - %(message)s')
-handler = logging.FileHandler('main.log', encoding='utf-8')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 start_keyboard = keyboard = ReplyKeyboardMarkup(
     [[KeyboardButton(text='Указать местоположение', request_location=True)]], resize_keyboard=True)
-main_keyboard = ReplyKeyboardMarkup([['Получить погоду'], ['Помощь']], resize_keyboard=True)
+main_keyboard = ReplyKeyboardMarkup([['Получить погоду'],
+                                     ['Погода на 3 часа', 'Прогноз на 5 дней'],
+                                     ['Утренний прогноз', 'Помощь']],
+                                    resize_keyboard=True)
+HORIZONS = {'Погода на 3 часа': HORIZON_3H,
+            'Прогноз на 5 дней': HORIZON_5D}
+
+ERROR_TEXT = 'Упс. Что-то пошло не так, попробуйте позже.'
+NO_LOCATION_TEXT = ('Сначала отправь мне свое местоположение '
+                    'и я смогу присылать тебе погоду. Нажми кнопку «Отправить местоположение».')
+
+user_registry = UserRegistry(UserRepository())
+subscriptions = SubscriptionRepository()
+geocoder = Geocoder()
+last_message_writer = LastMessageWriter(interval=LAST_MESSAGE_FLUSH_INTERVAL)
+forecast_cache = ForecastCache(ttl=FORECAST_CACHE_TTL,
+                               maxsize=FORECAST_CACHE_SIZE,
+                               precision=FORECAST_TILE_PRECISION,
+                               geocoder=geocoder if FORECAST_KEY == 'city' else None,
+                               stale_ttl=FORECAST_STALE_TTL,
+                               reload_interval=FORECAST_RELOAD_INTERVAL)
+forecast_requests = SingleFlight(failure_ttl=FORECAST_FAILURE_TTL)
+api_quota = QuotaManager(per_minute=API_QUOTA_PER_MINUTE,
+                         per_day=API_QUOTA_PER_DAY,
+                         reserve=API_QUOTA_RESERVE,
+                         max_wait=API_QUOTA_WAIT)
+weather_client = WeatherClient(URL_WEATHER_API, API_KEY,
+                               connect_timeout=WEATHER_CONNECT_TIMEOUT,
+                               read_timeout=WEATHER_READ_TIMEOUT,
+                               retries=WEATHER_RETRIES,
+                               pool_size=WEATHER_POOL_SIZE,
+                               breaker=CircuitBreaker(failure_threshold=WEATHER_BREAKER_THRESHOLD,
+                                                      reset_timeout=WEATHER_BREAKER_RESET),
+                               quota=api_quota)
+metrics.counter('bot_forecast_cache_stale_hits_total', 'Выдачи устаревших прогнозов из кэша.',
+                lambda: forecast_cache.stale_hits)
+metrics.counter('bot_forecast_cache_hits_total', 'Попадания в кэш прогнозов.', lambda: forecast_cache.hits)
+metrics.counter('bot_forecast_cache_misses_total', 'Промахи кэша прогнозов.', lambda: forecast_cache.misses)
+metrics.gauge('bot_forecast_cache_hit_ratio', 'Доля попаданий в кэш прогнозов.',
+              lambda: forecast_cache.hits / ((forecast_cache.hits + forecast_cache.misses) or 1))
+metrics.gauge('bot_forecast_cache_size', 'Число прогнозов в кэше.', lambda: forecast_cache.stats()['size'])
+metrics.counter('bot_log_dropped_records_total', 'Записи лога, отброшенные из-за заполненной очереди.',
+                dropped_records)
 
 
 def check_env() -> bool:
@@ -43,46 +128,56 @@ def check_env() -> bool:
 def create_update_user(chat_id: int, name: str, latitude: float, longitude: float, city: str = None) -> bool:
     """Функция создания или обновления данных пользователя.
     Если пользователя нет в базе то добавляем, если есть, но его координаты отличаются - то обновляем координаты.
-    Иначе ничего не делаем. Если пользователя был добавлен или обновлен то возвращает True иначе False."""
-    logger.info(f'Вызвана функция создания пользователя id: {chat_id}.')
-    session = Session(bind=engine)
-    user = session.query(User).get(chat_id)
+    Иначе ничего не делаем. Если пользователя был добавлен или обновлен то возвращает True иначе False.
+    Пользователь ищется в реестре user_registry, изменения записываются и в базу данных, и в реестр."""
+    logger.info('Вызвана функция создания пользователя id: %s.', chat_id)
+    user = user_registry.get(chat_id)
     if not user:
-        user = User(id=chat_id, name=name, latitude=latitude, longitude=longitude, city=city)
-        session.add(user)
-        session.commit()
-        session.close()
-        logger.info(f'В базу данных добавлен пользователь id: {chat_id}.')
+        user_registry.add(User(id=chat_id, name=name, latitude=latitude, longitude=longitude, city=city))
+        logger.info('В базу данных добавлен пользователь id: %s.', chat_id)
         return True
     elif abs(user.latitude - latitude) > 0.005 and abs(user.longitude - longitude) > 0.005:
-        logger.info(f'Пользователь с id: {chat_id} уже есть в базе данных, прислал новое местоположение.')
-        user.latitude = latitude
-        user.longitude = longitude
-        user.city = city
-        user.last_message = ''
-        session.commit()
-        session.close()
-        logger.info(f'Местоположение пользователя с id: {chat_id} обновлено.')
+        logger.info('Пользователь с id: %s уже есть в базе данных, прислал новое местоположение.', chat_id)
+        user_registry.update_location(chat_id, latitude, longitude, city)
+        logger.info('Местоположение пользователя с id: %s обновлено.', chat_id)
         return True
     else:
-        logger.info(f'Обновление не выполнено: местоположение пользователя с id: {chat_id} не изменилось. ')
+        if city and not user.city:
+            user_registry.set_city(chat_id, city)
+            logger.info('Заполнен город пользователя с id: %s.', chat_id)
+        logger.info('Обновление не выполнено: местоположение пользователя с id: %s не изменилось. ', chat_id)
         return False
 
 
+def get_city(latitude: float, longitude: float) -> Optional[str]:
+    """Функция определения названия ближайшего города по координатам."""
+    city = geocoder.lookup(latitude, longitude)
+    return city.name if city else None
+
+
+def fill_cities() -> None:
+    """Функция заполнения города для пользователей, добавленных до определения городов по координатам."""
+    user_registry.fill_cities(get_city)
+
+
+def get_user(chat_id: int) -> Optional[UserRecord]:
+    """Функция получения пользователя из реестра в памяти, без обращения к базе данных."""
+    return user_registry.get(chat_id)
+
+
 def update_last_message(chat_id: int, text: str) -> None:
-    """Функция позволяет хранить в базе последнее отправленное сообщение в течении часа.
-    При вызове обновляет поле last_message и last_update пользователя."""
-    logger.info(f'Вызвана функция обновления последнего сообщения пользователя id: {chat_id}.')
+    """Функция позволяет хранить в базе время последнего отправленного пользователю сообщения с погодой.
+    При вызове обновляет поле last_update пользователя, сам текст не сохраняется: его никто не читает.
+    Запись в базу отложенная: изменения записываются пакетами через last_message_writer."""
+    logger.info('Вызвана функция обновления последнего сообщения пользователя id: %s.', chat_id)
     if text:
-        session = Session(bind=engine)
-        user = session.query(User).get(chat_id)
-        user.last_message = text
-        user.last_update = datetime.now()
-        session.commit()
-        session.close()
-        logger.info(f'Было обновлено последнее сообщение пользователя id: {chat_id}, сообщение {text[:30]}.')
+        updated = datetime.now()
+        last_message_writer.put(chat_id, updated)
+        user_registry.touch(chat_id, updated)
+        logger.info('Поставлено в очередь обновление последнего сообщения пользователя id: %s, сообщение %s.',
+                    chat_id, text[:30])
     else:
-        logger.error(f'Обновление не выполнено: сообщение text не должно быть: {text[:30]}.')
+        logger.error('Обновление не выполнено: сообщение text не должно быть: %s.', text[:30])
 
 
 def send_message(update: update_type,
@@ -91,106 +186,130 @@ def send_message(update: update_type,
                  keyboard: Optional[ReplyKeyboardMarkup] = None) -> None:
     """Функция отправки сообщения в telegram."""
     chat_id = update.effective_chat.id
-    logger.info(f'Начата отправка сообщения пользователю {chat_id}.')
+    logger.info('Начата отправка сообщения пользователю %s.', chat_id)
     try:
-        if keyboard:
-            context.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
-        else:
-            context.bot.send_message(chat_id=chat_id, text=text)
+        with SEND_SECONDS.time('reply'):
+            if keyboard:
+                context.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+            else:
+                context.bot.send_message(chat_id=chat_id, text=text)
     except TelegramError as error:
-        logger.error(f'Не удалось отправить сообщение пользователю {chat_id}. Ошибка: {error}.')
+        TELEGRAM_ERRORS.inc('reply', type(error).__name__)
+        logger.error('Не удалось отправить сообщение пользователю %s. Ошибка: %s.', chat_id, error)
     else:
-        logger.info(f'Отправлено сообщение пользователю {chat_id} с текстом {text[:30]}...')
+        logger.info('Отправлено сообщение пользователю %s с текстом %s...', chat_id, text[:30])
 
 
-def get_response(latitude: float, longitude: float) -> Optional[dict]:
+def get_response(latitude: float,
+                 longitude: float,
+                 priority: str = INTERACTIVE,
+                 wait: Optional[float] = None) -> Optional[dict]:
     """Функция которая делает запрос к API по адресу https://api.openweathermap.org/data/2.5/forecast.
+    Запрос выполняется через weather_client: пул соединений, таймауты, повторы и автоматический выключатель.
+    Запрос списывается из квоты api_quota с приоритетом priority, квоту ждет не больше wait секунд.
     """
-    logger.info(f'Начато выполнение запроса к API {URL_WEATHER_API}.')
-    try:
-        params = {'lat': latitude,
-                  'lon': longitude,
-                  'lang': 'ru',
-                  'units': 'metric',
-                  'appid': API_KEY}
-        response = requests.get(url=URL_WEATHER_API, params=params).json()
-        if response.get('cod') == '200':
-            logger.info(f'Выполнен запрос к API {URL_WEATHER_API}. Response: {response}.')
-            return response
-        else:
-            logger.error(f'Запрос к API вернул не статус 200. Response: {response}.')
-            return None
-    except Exception as error:
-        logger.error(f'Не удалось выполнить запрос к API. Ошибка: {error}.')
+    logger.info('Начато выполнение запроса к API %s.', URL_WEATHER_API)
+    response = weather_client.get_forecast(latitude, longitude, priority, wait)
+    if response:
+        logger.info('Выполнен запрос к API %s.', URL_WEATHER_API)
+        if sample_payload(logger):
+            logger.debug('Response: %s.', payload(response))
+    return response
+
+
+def get_forecast(latitude: float,
+                 longitude: float,
+                 priority: str = INTERACTIVE,
+                 wait: Optional[float] = None) -> Optional[WeatherForecast]:
+    """Функция получения прогноза для квадрата координат, в котором находится пользователь.
+    Прогноз берется из общего кэша. Если он устарел, пользователь сразу получает устаревший прогноз,
+    а новый запрашивается в фоне. Если прогноза в кэше нет - он запрашивается у API
+    по координатам центра квадрата и сохраняется в кэш."""
+    key, tile_latitude, tile_longitude = forecast_cache.tile(latitude, longitude)
+    forecast_refresher.track(key, tile_latitude, tile_longitude)
+    forecast, fresh = forecast_cache.lookup(key)
+    if fresh:
+        logger.info('Прогноз для квадрата %s взят из кэша.', key)
+        return forecast
+    if forecast:
+        logger.info('Прогноз для квадрата %s устарел, отправлен из кэша и обновляется в фоне.', key)
+        forecast_refresher.revalidate(key, tile_latitude, tile_longitude)
+        return forecast
+    logger.info('Прогноза для квадрата %s нет в кэше.', key)
+    return fetch_forecast(key, tile_latitude, tile_longitude, priority, wait)
+
+
+def fetch_forecast(key: str,
+                   latitude: float,
+                   longitude: float,
+                   priority: str = INTERACTIVE,
+                   wait: Optional[float] = None) -> Optional[WeatherForecast]:
+    """Функция запроса прогноза для квадрата key у API и сохранения его в кэш.
+    Одновременные запросы для одного квадрата объединяются в один запрос к API.
+    Фоновые запросы объединяются отдельно, чтобы отказ по квоте для них не запоминался для запросов пользователей."""
+
+    def fetch() -> Optional[WeatherForecast]:
+        response = get_response(latitude, longitude, priority, wait)
+        fetched = parse_weather(response) if response else None
+        if fetched:
+            forecast_cache.put(key, fetched)
+        return fetched
+
+    return forecast_requests.do(key if priority == INTERACTIVE else f'{key} {priority}', fetch)
+
+
+def get_fallback_forecast(latitude: float, longitude: float) -> Optional[Tuple[WeatherForecast, str]]:
+    """Функция получения ближайшего прогноза из кэша, когда прогноз для квадрата пользователя получить
+    не удалось, например при исчерпанной квоте запросов к API.
+    Возвращает прогноз и пояснение, когда и для какого места он получен."""
+    found = forecast_cache.nearest(latitude, longitude, QUOTA_FALLBACK_DISTANCE)
+    if not found:
         return None
-
-
-def parse_weather(response: dict) -> Optional[str]:
-    """Разбирает ответ и формирует строку с погодой."""
-    logger.info(f'Начат парсинг ответа от API. Response: {response}')
-    try:
-        city_name = response['city']['name']
-        time_shift = response['city']['timezone']
-    except KeyError:
-        city_name = 'Не определено'
-        time_shift = 0
-        logger.error(f'Не удалось определить название населенного пункта. Response: {response}')
-    message = f'{get_emoji_str("U+1F3D9")} Погода в: {city_name}.\n\n'
-
+    forecast, updated, distance = found
+    minutes = int((datetime.now() - updated).total_seconds() // 60)
+    age = f'{minutes // 60} ч {minutes % 60} мин' if minutes >= 60 else f'{minutes} мин'
+    note = f'Сервис погоды сейчас перегружен. Прогноз получен {age} назад'
+    if distance >= 1:
+        note += f' для места в {distance:.0f} км от вас'
+    logger.info('Отправлен ближайший прогноз из кэша: получен %s мин назад, в %.1f км.', minutes, distance)
+    return forecast, note + '.'
+
+
+def get_broadcast_forecast(latitude: float,
+                           longitude: float,
+                           wait: float = 0) -> Optional[Tuple[WeatherForecast, Optional[str]]]:
+    """Функция получения прогноза для утренней рассылки: запрос к API с фоновым приоритетом,
+    квота ждется не больше wait секунд. Если прогноз получить не удалось - ближайший прогноз из кэша
+    с пояснением, когда и для какого места он получен."""
+    forecast = get_forecast(latitude, longitude, BACKGROUND, wait)
+    if forecast:
+        return forecast, None
+    return get_fallback_forecast(latitude, longitude)
+
+
+forecast_refresher = ForecastRefresher(forecast_cache, partial(fetch_forecast, priority=BACKGROUND),
+                                       top=REFRESH_TOP,
+                                       interval=REFRESH_INTERVAL,
+                                       lead=REFRESH_LEAD,
+                                       workers=REFRESH_WORKERS)
+
+
+@timed(PARSE_SECONDS)
+def parse_weather(response: dict) -> Optional[WeatherForecast]:
+    """Разбирает ответ API в компактный прогноз, сообщение из него формирует render_forecast."""
+    logger.info('Начат парсинг ответа от API.')
     try:
-        for data in response.get('list')[:8]:
-            date = data['dt_txt']
-            real_date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S") + timedelta(seconds=time_shift)
-            if real_date.day <= datetime.now().day:
-                today_text = 'Сегодня в'
-            else:
-                today_text = 'Завтра в'
-            weather = data['weather'][0]['description']
-            code = int(data['weather'][0]['id'])
-            temp = round(float(data['main']['temp']))
-            temp_feels_like = round(float(data['main']['feels_like']))
-            humidity = round(float(data['main']['humidity']))
-            wind_speed = float(data['wind']['speed'])
-            emoji = get_emoji(code)
-            # Получаем эмоджи для кода
-            if not emoji:
-                logger.error(f'Не удалось получить emoji для кода {code}.')
-                emoji = get_emoji_str('U+2753')
-            # Формируем сообщение о ветре
-            wind = ''
-            if wind_speed <= 1.5:
-                wind = 'Ветра нет'
-            elif 1.5 < wind_speed <= 5.4:
-                wind = 'Легкий ветерок'
-            elif 5.4 < wind_speed <= 10.7:
-                wind = 'Ветер'
-            elif 10.7 < wind_speed <= 17.1:
-                wind = 'Сильный ветер'
-            elif 17.1 < wind_speed:
-                wind = 'Шторм'
-            # Формируем итоговое сообщение
-            message += (f'{get_emoji_str("U+1F558")} {today_text} {real_date.strftime("%H:%M")}\n'
-                        f'{emoji} {weather.capitalize()}.\n'
-                        f'{get_emoji_str("U+1F321")} Температура {temp}°C (ощущается {temp_feels_like}°C).\n'
-                        f'{get_emoji_str("U+1F4A7")} Влажность {humidity}%.\n'
-                        f'{get_emoji_str("U+1F4A8")} {wind} ({wind_speed} м/с).\n\n')
-
-        sunrise = response['city'].get('sunrise')
-        sunset = response['city'].get('sunset')
-
-        if all((sunrise, sunset)):
-            sunrise_time = datetime.fromtimestamp(sunrise + time_shift).strftime('%H:%M')
-            sunset_time = datetime.fromtimestamp(sunset + time_shift).strftime('%H:%M')
-            message += (f'{get_emoji_str("U+1F31E")} Время рассвета: {sunrise_time} '
-                        f'\n{get_emoji_str("U+1F31A")} Время заката: {sunset_time}')
-        else:
-            logger.error(f'Не удалось получить ключи sunrise, sunset, timezone. Response: {response}')
-    except KeyError:
-        logger.error(f'Не удалось разобрать запрос. Response: {response}')
+        forecast = WeatherForecast.from_response(response)
+    except (KeyError, IndexError, TypeError, ValueError) as error:
+        logger.error('Не удалось разобрать запрос. Ошибка: %s. Response: %s', error, payload(response))
         return None
-    return message
+    if not forecast.sunrise or not forecast.sunset:
+        logger.error('Не удалось получить ключи sunrise, sunset, timezone. Response: %s', payload(response))
+    return forecast
 
 
+@timed(HANDLER_SECONDS)
+@with_session
 def handler_start(update: update_type, context: callbackcontext) -> None:
     """Функция обработки команды /start.
     отправляет пользователю сообщение и кдавиатуру с кнопкной «Отправить местоположение»."""
@@ -199,9 +318,11 @@ def handler_start(update: update_type, context: callbackcontext) -> None:
     send_message(update, context, text, start_keyboard)
 
 
+@timed(HANDLER_SECONDS)
+@with_session
 def handler_get_coordinates(update: update_type, context: callbackcontext) -> None:
     """Функция обработки сообщения с местоположением.
-    Извлекает широту и долготу из сообщения и передает функции create_update_user,
+    Извлекает широту и долготу из сообщения, определяет по ним ближайший город и передает функции create_update_user,
     которая либо создает нового пользователя, либо обновляет координаты и отправляет погоду,
     либо ничего не делает и отправляет сообщение «Ваше местоположение не изменилось».
     """
@@ -213,61 +334,61 @@ def handler_get_coordinates(update: update_type, context: callbackcontext) -> No
         latitude = update.message.location.latitude
         longitude = update.message.location.longitude
     except Exception as e:
-        logger.error(f'Не удалось определить координаты пользователя {chat_id}. Ошибка: {e}.')
+        logger.error('Не удалось определить координаты пользователя %s. Ошибка: %s.', chat_id, e)
     else:
-        logger.info(f'Определены координаты пользователя {chat_id}. Широта: {latitude}, долгота {longitude}.')
-        if create_update_user(chat_id, name, latitude, longitude):
+        logger.info('Определены координаты пользователя %s. Широта: %s, долгота %s.', chat_id, latitude, longitude)
+        if create_update_user(chat_id, name, latitude, longitude, get_city(latitude, longitude)):
             handler_get_weather(update, context)
         else:
             text = 'Ваше местоположение не изменилось.'
             send_message(update, context, text, main_keyboard)
 
 
+def get_horizon(update: update_type) -> str:
+    """Период прогноза по тексту сообщения, по умолчанию - сутки."""
+    text = update.message.text if update.message else None
+    return HORIZONS.get(text, HORIZON_24H)
+
+
+@timed(HANDLER_SECONDS)
+@with_session
 def handler_get_weather(update: update_type, context: callbackcontext) -> None:
-    """Функция обработки сообщения с текстом «Получить текущую погоду».
-    Функция либо делает запрос к API если данные устарели или еще не запрашивались,
-    либо берет последнее сообщение в базе данных.
+    """Функция обработки сообщения с текстом «Получить текущую погоду», «Погода на 3 часа» или «Прогноз на 5 дней».
+    Прогноз берется из общего для соседних пользователей кэша,
+    запрос к API делается только если данные для квадрата устарели или еще не запрашивались.
+    Сообщение формируется из прогноза в момент отправки.
     """
-    logger.info(f'Получена команда «Получить погоду».')
-    session = Session(bind=engine)
+    logger.info('Получена команда «Получить погоду».')
     chat_id = update.effective_chat.id
-    user = session.query(User).get(chat_id)
-    session.close()
+    user = get_user(chat_id)
     # Ситуация если пользователь не отправил местоположение, но отправил сообщение «Получить погоду»
     if not user:
-        logger.error(f'Не был найден пользователь if: {chat_id}.')
-        text = ('Сначала отправь мне свое местоположение '
-                'и я смогу присылать тебе погоду. Нажми кнопку «Отправить местоположение».')
-        send_message(update, context, text, start_keyboard)
+        logger.error('Не был найден пользователь if: %s.', chat_id)
+        send_message(update, context, NO_LOCATION_TEXT, start_keyboard)
         return
 
-    # если для данного пользователя или местоположения еще не выполнялся запрос к API
-    if not user.last_message or datetime.now() - user.last_update > timedelta(hours=1):
-        logger.info((f'Для данного пользователя id {chat_id} или местоположения еще не выполнялся запрос к API '
-                     f'или данные устарели.'))
-        latitude, longitude = user.latitude, user.longitude
-        response = get_response(latitude, longitude)
-        if not response:
-            text = 'Упс. Что-то пошло не так, попробуйте позже.'
-            send_message(update, context, text, main_keyboard)
-            return
-        text = parse_weather(response)
-        if not text:
-            text = 'Упс. Что-то пошло не так, попробуйте позже.'
-        else:
-            update_last_message(user.id, text)
-    # если запрос выполнялся и прошло меньше часа
-    else:
-        logger.info((f'С момента последнего запроса для пользователя if {chat_id}'
-                     f'не прошел час, загружаем сообщение из базы данных.'))
-        text = user.last_message
+    forecast = get_forecast(user.latitude, user.longitude)
+    note = None
+    if not forecast:
+        forecast, note = get_fallback_forecast(user.latitude, user.longitude) or (None, None)
+    if not forecast:
+        send_message(update, context, ERROR_TEXT, main_keyboard)
+        return
+    horizon = get_horizon(update)
+    with RENDER_SECONDS.time(horizon):
+        text = render_forecast(forecast, horizon)
+    if note:
+        text = f'{text}\n\n{note}'
+    update_last_message(user.id, text)
 
     send_message(update, context, text, main_keyboard)
 
 
+@timed(HANDLER_SECONDS)
+@with_session
 def handler_help(update: update_type, context: callbackcontext) -> None:
     """Функция обработки сообщения с текстом «Помощь»."""
-    logger.info(f'Получена команда «Помощь».')
+    logger.info('Получена команда «Помощь».')
     text = ('Бот позволяет получить погоду в текущем местоположении. '
             'Если необходимо изменить местоположение - отправь боту новую геопозицию. '
             'Погода берется с сайта https://openweathermap.org.\n'
@@ -275,48 +396,115 @@ def handler_help(update: update_type, context: callbackcontext) -> None:
     send_message(update, context, text, main_keyboard)
 
 
+@timed(HANDLER_SECONDS)
+@with_session
+def handler_subscription(update: update_type, context: callbackcontext) -> None:
+    """Функция обработки сообщения с текстом «Утренний прогноз».
+    Подписывает пользователя на ежедневную утреннюю рассылку прогноза, а если он уже подписан - отписывает."""
+    logger.info('Получена команда «Утренний прогноз».')
+    chat_id = update.effective_chat.id
+    if not get_user(chat_id):
+        send_message(update, context, NO_LOCATION_TEXT, start_keyboard)
+        return
+    if subscriptions.is_subscribed(chat_id):
+        subscriptions.unsubscribe(chat_id)
+        logger.info('Пользователь %s отписался от утреннего прогноза.', chat_id)
+        text = 'Вы отписались от утреннего прогноза.'
+    else:
+        subscriptions.subscribe(chat_id)
+        logger.info('Пользователь %s подписался на утренний прогноз.', chat_id)
+        text = (f'Каждый день в {BROADCAST_TIME.strftime("%H:%M")} ({BROADCAST_TIME.tzinfo}) я буду присылать '
+                f'прогноз погоды. Чтобы отписаться, нажми «Утренний прогноз» еще раз.')
+    send_message(update, context, text, main_keyboard)
+
+
+@timed(HANDLER_SECONDS)
+@with_session
 def handler_admin(update: update_type, context: callbackcontext) -> None:
     """Функционал для админа."""
-    logger.info(f'Получена команда «/admin».')
+    logger.info('Получена команда «/admin».')
     chat_id = update.effective_chat.id
     if chat_id == ADMIN_ID:
-        logger.info(f'Отправка информации админу от пользователях.')
-        session = Session(bind=engine)
-        users = session.query(User).all()
+        logger.info('Отправка информации админу от пользователях.')
         text = 'Информация о пользователях:\n'
-        for user in users:
-            text += f'Пользователь: @{user.name}, последнее обновление {user.last_update.strftime("%d.%m.%Y %H:%M")}\n'
+        for user in user_registry.all():
+            last_update = user.last_update.strftime("%d.%m.%Y %H:%M") if user.last_update else 'нет'
+            city = user.city or 'город не определен'
+            text += f'Пользователь: @{user.name}, {city}, последнее обновление {last_update}\n'
+        stats = forecast_cache.stats()
+        text += (f'\nКэш прогнозов: записей {stats["size"]}, попаданий {stats["hits"]}, '
+                 f'промахов {stats["misses"]}, из них отдано устаревших {stats["stale_hits"]}, '
+                 f'вытеснений {stats["evictions"]}.')
+        remaining = ', '.join(f'{name} {tokens:.0f}' for name, tokens in api_quota.remaining().items())
+        text += f'\nОстаток квоты запросов к API: {remaining or "не ограничена"}.'
+        text += (f'\nРеестр пользователей: записей {len(user_registry)}, '
+                 f'около {user_registry.footprint() / 2 ** 20:.1f} МБ.')
         send_message(update, context, text, main_keyboard)
-        session.close()
     else:
-        logger.warning(f'Пользователь с id: {chat_id} хотел получить доступ к админ функционалу.')
+        logger.warning('Пользователь с id: %s хотел получить доступ к админ функционалу.', chat_id)
         text = 'Нет доступа к данному функционалу'
         send_message(update, context, text, main_keyboard)
 
 
-def main() -> None:
-    """Основная функция."""
-    if not check_env():
-        logger.critical('Не найдены переменные виртуального окружения')
-        sys.exit()
-
-    updater = Updater(token=TOKEN)
-    dispatcher = updater.dispatcher
+def add_handlers(dispatcher: Dispatcher) -> None:
+    """Регистрирует обработчики сообщений в диспетчере."""
     map_handler = MessageHandler(Filters.location, handler_get_coordinates)
     command_handler = MessageHandler(Filters.command(('/start',)), handler_start)
     weather_handler = MessageHandler(Filters.text(('Получить текущую погоду',
-                                                   'Получить погоду',)), handler_get_weather)
+                                                   'Получить погоду',
+                                                   *HORIZONS)), handler_get_weather)
     help_handler = MessageHandler(Filters.text(('Помощь',)), handler_help)
+    subscription_handler = MessageHandler(Filters.text(('Утренний прогноз',)), handler_subscription)
     admin_handler = MessageHandler(Filters.text(('admin',)), handler_admin)
     dispatcher.add_handler(map_handler)
     dispatcher.add_handler(command_handler)
     dispatcher.add_handler(weather_handler)
     dispatcher.add_handler(admin_handler)
     dispatcher.add_handler(help_handler)
+    dispatcher.add_handler(subscription_handler)
+
+
+def start_broadcasts(dispatcher: Dispatcher, reload_users: bool = False) -> DeliveryQueue:
+    """Запускает очередь отправки рассылки и планирует ежедневную рассылку утреннего прогноза
+    в очереди задач диспетчера dispatcher.
+    reload_users нужен, если пользователей изменяют другие процессы и реестр этого процесса может устареть."""
+    job_queue = dispatcher.job_queue
+    # Dispatcher связывает с собой только очередь задач, которую создает сам, переданную нужно связать явно
+    job_queue.set_dispatcher(dispatcher)
+    delivery = DeliveryQueue(dispatcher.bot,
+                             rate=DELIVERY_RATE,
+                             per_chat_interval=DELIVERY_CHAT_INTERVAL,
+                             workers=DELIVERY_WORKERS,
+                             on_forbidden=subscriptions.unsubscribe)
+    broadcaster = Broadcaster(subscriptions, user_registry, forecast_cache.tile, get_broadcast_forecast, delivery,
+                              keyboard=main_keyboard, workers=BROADCAST_WORKERS, reload_users=reload_users)
+    broadcaster.schedule(job_queue, BROADCAST_TIME, timedelta(minutes=BROADCAST_PREFETCH_MINUTES))
+    delivery.start()
+    return delivery
+
+
+def main() -> None:
+    """Основная функция."""
+    if not check_env():
+        logger.critical('Не найдены переменные виртуального окружения')
+        sys.exit()
+
+    user_registry.load()
+    fill_cities()
+    forecast_cache.load()
+    last_message_writer.start()
+    forecast_refresher.start()
+    metrics.start(METRICS_HOST, METRICS_PORT, METRICS_DUMP_FILE, METRICS_DUMP_INTERVAL)
+    updater = Updater(token=TOKEN)
+    add_handlers(updater.dispatcher)
+    delivery = start_broadcasts(updater.dispatcher)
 
     updater.start_polling()
     updater.idle()
-    logger.info(f'Бот запущен')
+    delivery.stop()
+    forecast_refresher.stop()
+    last_message_writer.stop()
+    logger.info('Бот запущен')
 
 
 if __name__ == '__main__':
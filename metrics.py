@@ -0,0 +1,240 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Счетчик, который только увеличивается, с необязательными метками."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: Any, amount: float = 1) -> None:
+        key = tuple(str(value) for value in values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in values]
+
+
+class Histogram:
+    """Гистограмма длительностей с корзинами buckets, с необязательными метками."""
+
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Метки -> [число наблюдений в каждой корзине и сверх последней, сумма наблюдений]
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, *values: Any) -> None:
+        key = tuple(str(value) for value in values)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            value[0][index] += 1
+            value[1] += seconds
+
+    @contextmanager
+    def time(self, *values: Any) -> Iterator[None]:
+        """Измеряет длительность блока with."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *values)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Значение, которое вычисляется функцией func в момент чтения метрик."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def samples(self) -> List[str]:
+        return [f'{self.name} {self.func()}']
+
+
+class CallbackCounter(Gauge):
+    """Счетчик, который только увеличивается и вычисляется функцией func в момент чтения метрик,
+    например счетчик попаданий в кэш, который ведет сам кэш."""
+
+    type = 'counter'
+
+
+REGISTRY: Dict[str, Any] = {}
+
+
+def register(metric: Any) -> Any:
+    REGISTRY[metric.name] = metric
+    return metric
+
+
+def gauge(name: str, documentation: str, func: Callable[[], float]) -> Gauge:
+    return register(Gauge(name, documentation, func))
+
+
+def counter(name: str, documentation: str, func: Callable[[], float]) -> CallbackCounter:
+    return register(CallbackCounter(name, documentation, func))
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        try:
+            lines.extend(metric.samples())
+        except Exception as error:
+            logger.error('Не удалось получить значение метрики %s. Ошибка: %s.', metric.name, error)
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram: Histogram, *values: Any) -> Callable:
+    """Декоратор, измеряющий длительность вызова функции. Без меток в values меткой служит имя функции."""
+
+    def decorator(func: Callable) -> Callable:
+        labels = values or ((func.__name__,) if histogram.labels else ())
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+HANDLER_SECONDS = register(Histogram('bot_handler_seconds', 'Длительность обработки обновления.', ('handler',)))
+DB_SECONDS = register(Histogram('bot_db_seconds', 'Длительность запросов к базе данных.', ('operation',)))
+WEATHER_SECONDS = register(Histogram('bot_weather_api_seconds', 'Длительность запросов к API погоды.'))
+WEATHER_RESPONSES = register(Counter('bot_weather_api_responses_total', 'Ответы API погоды по статусу.',
+                                     ('status',)))
+PARSE_SECONDS = register(Histogram('bot_parse_seconds', 'Длительность разбора ответа API погоды.'))
+RENDER_SECONDS = register(Histogram('bot_render_seconds', 'Длительность формирования сообщения с прогнозом.',
+                                    ('horizon',)))
+SEND_SECONDS = register(Histogram('bot_send_seconds', 'Длительность отправки сообщения в Telegram.', ('source',)))
+TELEGRAM_ERRORS = register(Counter('bot_telegram_errors_total', 'Ошибки Telegram при отправке сообщений.',
+                                   ('source', 'error')))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+def start_http_server(host: str, port: int) -> ThreadingHTTPServer:
+    """Запускает HTTP сервер с метриками по адресу /metrics в фоновом потоке."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+    logger.info('Метрики доступны на http://%s:%s/metrics.', host, port)
+    return server
+
+
+def dump(path: str) -> None:
+    """Записывает метрики в файл path, файл заменяется целиком, поэтому его можно читать в любой момент."""
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        file.write(render())
+    os.replace(temporary, path)
+
+
+def start_dump(path: str, interval: float) -> threading.Event:
+    """Раз в interval секунд записывает метрики в файл path. Запись прекращается после set() у возвращенного события."""
+    stopped = threading.Event()
+
+    def run() -> None:
+        while not stopped.wait(interval):
+            try:
+                dump(path)
+            except OSError as error:
+                logger.error('Не удалось записать метрики в %s. Ошибка: %s.', path, error)
+
+    threading.Thread(target=run, name='metrics_dump', daemon=True).start()
+    return stopped
+
+
+def start(host: str, port: int, dump_path: Optional[str], dump_interval: float) -> None:
+    """Включает выдачу метрик: HTTP сервер, если port не 0, и запись в файл, если задан dump_path."""
+    if port:
+        try:
+            start_http_server(host, port)
+        except OSError as error:
+            logger.error('Не удалось запустить сервер метрик на порту %s. Ошибка: %s.', port, error)
+    if dump_path and dump_interval > 0:
+        start_dump(dump_path, dump_interval)
@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from database import Quota
+from metrics import Counter, register
+from rate_limit import TokenBucket
+from repository import session_scope
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов к API: запрос пользователя и фоновые задачи (обновление кэша, рассылка)
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+# Сколько раз повторять списание, если состояние одновременно изменил другой процесс
+SAVE_ATTEMPTS = 5
+
+QUOTA_DENIED = register(Counter('bot_api_quota_denied_total', 'Запросы к API, отклоненные из-за квоты.',
+                                ('priority',)))
+
+
+class QuotaManager:
+    """Учет квоты запросов к API погоды: ведра токенов на минуту (per_minute) и на сутки (per_day).
+    Состояние ведер хранится в таблице api_quota, поэтому квота общая для всех процессов бота
+    и сохраняется при перезапуске. Фоновые запросы не могут израсходовать последнюю долю reserve
+    каждого ведра: она оставляется для запросов пользователей. Запрос пользователя по умолчанию ждет токен
+    не больше max_wait секунд, фоновый запрос не ждет, если для него не задано время ожидания."""
+
+    def __init__(self, per_minute: int = 0, per_day: int = 0, reserve: float = 0.2, max_wait: float = 1) -> None:
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.buckets: Dict[str, TokenBucket] = {}
+        if per_minute:
+            self.buckets['minute'] = TokenBucket(per_minute / 60, per_minute, clock=time.time)
+        if per_day:
+            self.buckets['day'] = TokenBucket(per_day / 86400, per_day, clock=time.time)
+        self._lock = threading.Lock()
+
+    def acquire(self, priority: str = INTERACTIVE, wait: Optional[float] = None) -> bool:
+        """Списывает один запрос из квоты, ожидая токен не больше wait секунд.
+        Возвращает False, если квота исчерпана."""
+        if not self.buckets:
+            return True
+        if wait is None:
+            wait = self.max_wait if priority == INTERACTIVE else 0
+        deadline = time.monotonic() + wait
+        while True:
+            delay = self.try_acquire(priority)
+            if not delay:
+                return True
+            if time.monotonic() + delay > deadline:
+                logger.warning('Квота запросов к API исчерпана, запрос с приоритетом %s отклонен.', priority)
+                QUOTA_DENIED.inc(priority)
+                return False
+            time.sleep(delay)
+
+    def try_acquire(self, priority: str = INTERACTIVE) -> float:
+        """Списывает один запрос из всех ведер и возвращает 0, либо ничего не списывает и возвращает,
+        через сколько секунд квоты будет достаточно."""
+        share = 0 if priority == INTERACTIVE else self.reserve
+        with self._lock:
+            for _ in range(SAVE_ATTEMPTS):
+                try:
+                    with session_scope() as session:
+                        rows = {row.name: row for row in session.query(Quota).filter(Quota.name.in_(self.buckets))}
+                        taken = []
+                        for name, bucket in self.buckets.items():
+                            row = rows.get(name)
+                            if row:
+                                bucket.restore(row.tokens, row.updated)
+                            delay = bucket.try_acquire(1, reserve=bucket.capacity * share)
+                            if delay:
+                                for acquired in taken:
+                                    acquired.release(1)
+                                return delay
+                            taken.append(bucket)
+                        if self._save(session, rows):
+                            return 0
+                        session.rollback()
+                except IntegrityError:
+                    pass
+            logger.error('Не удалось списать запрос из квоты: состояние постоянно изменяется другими процессами.')
+            return self.max_wait
+
+    def remaining(self) -> Dict[str, float]:
+        """Остаток токенов в ведрах на момент последнего списания."""
+        return {name: bucket.tokens for name, bucket in self.buckets.items()}
+
+    def _save(self, session, rows: Dict[str, Quota]) -> bool:
+        """Сохраняет состояние ведер, если его не изменил другой процесс после чтения."""
+        for name, bucket in self.buckets.items():
+            row = rows.get(name)
+            if row is None:
+                session.add(Quota(name=name, tokens=bucket.tokens, updated=bucket.updated))
+                session.flush()
+                continue
+            result = session.execute(update(Quota)
+                                     .where(Quota.name == name, Quota.updated == row.updated)
+                                     .values(tokens=bucket.tokens, updated=bucket.updated)
+                                     .execution_options(synchronize_session=False))
+            if not result.rowcount:
+                return False
+        return True
@@ -0,0 +1,50 @@
+import threading
+import time
+from typing import Callable
+
+
+class TokenBucket:
+    """Ограничитель частоты: в ведро вмещается capacity токенов, они пополняются со скоростью rate в секунду.
+    Каждая операция забирает токен, если токенов нет - операцию нужно отложить.
+    clock - источник времени, для состояния, которое сохраняется между перезапусками, - time.time."""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1, reserve: float = 0) -> float:
+        """Забирает токены, если после этого в ведре останется не меньше reserve токенов, и возвращает 0.
+        Иначе ничего не забирает и возвращает, через сколько секунд токенов будет достаточно."""
+        with self._lock:
+            self._refill(self.clock())
+            if self.tokens - reserve >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens + reserve - self.tokens) / self.rate
+
+    def release(self, tokens: float = 1) -> None:
+        """Возвращает в ведро токены, забранные для операции, которая не была выполнена."""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def restore(self, tokens: float, updated: float) -> None:
+        """Восстанавливает сохраненное состояние ведра."""
+        with self._lock:
+            self.tokens = tokens
+            self.updated = updated
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Ждет, пока токенов будет достаточно, и забирает их."""
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return
+            time.sleep(delay)
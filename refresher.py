@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from forecast import WeatherForecast
+from forecast_cache import ForecastCache
+from metrics import Counter, register
+
+logger = logging.getLogger(__name__)
+
+# OpenWeatherMap обновляет прогноз по трехчасовым интервалам
+SLOT_SECONDS = 3 * 60 * 60
+
+REFRESHES = register(Counter('bot_forecast_refresh_total', 'Фоновые обновления прогнозов по причине.', ('reason',)))
+
+
+def slot_start(now: datetime) -> datetime:
+    """Начало текущего трехчасового интервала прогноза."""
+    timestamp = now.timestamp()
+    return datetime.fromtimestamp(timestamp - timestamp % SLOT_SECONDS)
+
+
+class ForecastRefresher:
+    """Фоновое обновление прогнозов в кэше.
+    Устаревший прогноз показывается пользователю сразу, а новый запрашивается в фоне (revalidate).
+    Кроме того, для top самых популярных квадратов прогноз обновляется заранее: за lead секунд до того,
+    как он устареет, и в начале каждого трехчасового интервала, когда первый интервал прогноза уже прошел.
+    Популярность квадрата - число запросов, которое уменьшается вдвое раз в decay_interval секунд."""
+
+    def __init__(self,
+                 cache: ForecastCache,
+                 fetch: Callable[[str, float, float], Optional[WeatherForecast]],
+                 top: int = 100,
+                 interval: float = 60,
+                 lead: float = 600,
+                 workers: int = 4,
+                 decay_interval: float = 3600) -> None:
+        self.cache = cache
+        self.fetch = fetch
+        self.top = top
+        self.interval = interval
+        self.lead = timedelta(seconds=lead)
+        self.decay_interval = decay_interval
+        self._popularity: Dict[str, float] = {}
+        self._locations: Dict[str, Tuple[float, float]] = {}
+        self._pending = set()
+        self._decayed = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresher')
+
+    def track(self, key: str, latitude: float, longitude: float) -> None:
+        """Учитывает запрос прогноза для квадрата key с координатами центра latitude, longitude."""
+        with self._lock:
+            self._popularity[key] = self._popularity.get(key, 0) + 1
+            self._locations[key] = (latitude, longitude)
+
+    def revalidate(self, key: str, latitude: float, longitude: float, reason: str = 'stale') -> None:
+        """Запрашивает прогноз для квадрата в фоне, если он еще не запрашивается."""
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        REFRESHES.inc(reason)
+        self._executor.submit(self._refresh, key, latitude, longitude)
+
+    def popular(self) -> List[Tuple[str, float, float]]:
+        """top самых популярных квадратов: ключ и координаты центра."""
+        with self._lock:
+            keys = sorted(self._popularity, key=self._popularity.get, reverse=True)[:self.top]
+            return [(key, *self._locations[key]) for key in keys]
+
+    def refresh_popular(self) -> int:
+        """Обновляет прогнозы популярных квадратов, которые скоро устареют или получены до начала интервала.
+        Возвращает число запущенных обновлений."""
+        self._decay()
+        now = datetime.now()
+        boundary = slot_start(now)
+        started = 0
+        for key, latitude, longitude in self.popular():
+            updated = self.cache.updated(key)
+            if updated and updated >= boundary and now - updated < self.cache.ttl - self.lead:
+                continue
+            self.revalidate(key, latitude, longitude, 'popular')
+            started += 1
+        if started:
+            logger.info('Запущено обновление прогнозов популярных квадратов: %s.', started)
+        return started
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='forecast_refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh_popular()
+            except Exception as error:
+                logger.exception('Ошибка при обновлении популярных прогнозов: %s.', error)
+
+    def _refresh(self, key: str, latitude: float, longitude: float) -> None:
+        try:
+            if not self.fetch(key, latitude, longitude):
+                logger.warning('Не удалось обновить прогноз для квадрата %s в фоне.', key)
+        except Exception as error:
+            logger.exception('Ошибка при обновлении прогноза для квадрата %s: %s.', key, error)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _decay(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._decayed < self.decay_interval:
+                return
+            self._decayed = now
+            self._popularity = {key: count / 2 for key, count in self._popularity.items() if count >= 1}
+            self._locations = {key: self._locations[key] for key in self._popularity}
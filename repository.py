@@ -0,0 +1,144 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Subscription, User, db_session
+from metrics import DB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """Отдельная сессия с одной транзакцией: commit при успехе, rollback при ошибке."""
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def with_session(func: Callable) -> Callable:
+    """Декоратор обработчика обновления.
+    Все обращения к базе данных внутри обработчика используют одну сессию db_session,
+    которая закрывается после обработки обновления."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_session.remove()
+
+    return wrapper
+
+
+class UserRepository:
+    """Доступ к таблице users через сессию текущего обновления."""
+
+    @property
+    def session(self) -> Session:
+        return db_session()
+
+    def get(self, chat_id: int) -> Optional[User]:
+        with DB_SECONDS.time('user_get'):
+            return self.session.get(User, chat_id)
+
+    def all(self) -> List[User]:
+        return self.session.query(User).all()
+
+    def add(self, user: User) -> None:
+        self.session.add(user)
+        self.session.commit()
+
+    def commit(self) -> None:
+        self.session.commit()
+
+
+class SubscriptionRepository:
+    """Подписки на утреннюю рассылку. Используется и из обработчиков, и из задач рассылки,
+    поэтому каждый вызов работает в отдельной сессии."""
+
+    def is_subscribed(self, chat_id: int) -> bool:
+        with session_scope() as session:
+            return session.get(Subscription, chat_id) is not None
+
+    def subscribe(self, chat_id: int) -> None:
+        with session_scope() as session:
+            session.merge(Subscription(chat_id=chat_id))
+
+    def unsubscribe(self, chat_id: int) -> None:
+        with session_scope() as session:
+            session.query(Subscription).filter(Subscription.chat_id == chat_id).delete()
+
+    def chat_ids(self) -> List[int]:
+        with session_scope() as session:
+            return [chat_id for (chat_id,) in session.query(Subscription.chat_id)]
+
+
+class LastMessageWriter:
+    """Отложенная запись времени последнего отправленного пользователю сообщения.
+    Изменения last_update копятся в памяти (для пользователя хранится только последнее)
+    и записываются в базу одной транзакцией раз в interval секунд
+    или сразу, как только накопилось max_batch изменений."""
+
+    def __init__(self, interval: float = 1.0, max_batch: int = 500) -> None:
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, chat_id: int, updated: Optional[datetime] = None) -> None:
+        with self._lock:
+            self._pending[chat_id] = updated or datetime.now()
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.set()
+
+    def flush(self) -> int:
+        """Записывает накопленные изменения в базу, возвращает число обновленных пользователей."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        mappings = [{'id': chat_id, 'last_update': updated} for chat_id, updated in pending.items()]
+        try:
+            with DB_SECONDS.time('last_message_flush'), session_scope() as session:
+                session.bulk_update_mappings(User, mappings)
+        except Exception as error:
+            logger.error('Не удалось записать время последних сообщений пользователей. Ошибка: %s.', error)
+            with self._lock:
+                for chat_id, value in pending.items():
+                    self._pending.setdefault(chat_id, value)
+            return 0
+        logger.info('Записано время последних сообщений пользователей: %s.', len(mappings))
+        return len(mappings)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='last_message_writer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновую запись и записывает оставшиеся изменения."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
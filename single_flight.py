@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """Выполняющийся запрос, результат которого ждут все вызвавшие его потоки."""
+
+    __slots__ = ('event', 'result')
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """Объединяет одновременные запросы с одинаковым ключом в один.
+    Первый поток выполняет запрос, остальные ждут и получают его результат.
+    Неудачный результат (None) запоминается на failure_ttl секунд,
+    чтобы при недоступном API не повторять запрос для каждого пользователя."""
+
+    def __init__(self, failure_ttl: float = 10) -> None:
+        self.failure_ttl = failure_ttl
+        self._calls = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """Выполняет func для ключа key либо дожидается уже выполняющегося запроса с тем же ключом."""
+        with self._lock:
+            if self._recently_failed(key):
+                return None
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            logger.info('Запрос для ключа %s уже выполняется, ожидаем его результат.', key)
+            call.event.wait()
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:
+            logger.error('Запрос для ключа %s завершился ошибкой: %s.', key, error)
+            call.result = None
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.result is None:
+                    self._remember_failure(key)
+            call.event.set()
+        return call.result
+
+    def _recently_failed(self, key: str) -> bool:
+        expires = self._failures.get(key)
+        if expires is None:
+            return False
+        if time.monotonic() < expires:
+            return True
+        del self._failures[key]
+        return False
+
+    def _remember_failure(self, key: str) -> None:
+        now = time.monotonic()
+        if len(self._failures) > 1000:
+            self._failures = {k: v for k, v in self._failures.items() if v > now}
+        self._failures[key] = now + self.failure_ttl
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Вариант SingleFlight для корутин: одновременные корутины с одинаковым ключом
+    ждут одну задачу в цикле событий. Все вызовы должны выполняться в одном цикле событий."""
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        if self._recently_failed(key):
+            return None
+        future = self._calls.get(key)
+        if future is not None:
+            logger.info('Запрос для ключа %s уже выполняется, ожидаем его результат.', key)
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        result = None
+        try:
+            result = await func()
+        except Exception as error:
+            logger.error('Запрос для ключа %s завершился ошибкой: %s.', key, error)
+        finally:
+            del self._calls[key]
+            if result is None:
+                self._remember_failure(key)
+            future.set_result(result)
+        return result
@@ -0,0 +1,132 @@
+import logging
+import sys
+import threading
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, List, Optional
+
+from database import User
+from repository import UserRepository, session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class UserRecord:
+    """Компактная запись о пользователе в памяти."""
+
+    __slots__ = ('id', 'name', 'latitude', 'longitude', 'city', 'last_update')
+
+    def __init__(self,
+                 id: int,
+                 name: Optional[str],
+                 latitude: float,
+                 longitude: float,
+                 city: Optional[str] = None,
+                 last_update: Optional[datetime] = None) -> None:
+        self.id = id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.city = city
+        self.last_update = last_update
+
+
+class UserRegistry:
+    """Реестр пользователей в памяти, загружается из таблицы users при запуске бота.
+    Чтение не обращается к базе данных, изменения сначала записываются в базу, затем в реестр."""
+
+    def __init__(self, repository: UserRepository) -> None:
+        self.repository = repository
+        self._records: Dict[int, UserRecord] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def load(self) -> None:
+        """Загружает всех пользователей из базы данных."""
+        records = {}
+        with session_scope() as session:
+            rows = session.query(User.id, User.name, User.latitude, User.longitude,
+                                 User.city, User.last_update).yield_per(10000)
+            for row in rows:
+                records[row.id] = UserRecord(*row)
+        with self._lock:
+            self._records = records
+        logger.info('Загружено пользователей: %s, занимают в памяти около %.1f МБ.',
+                    len(records), self.footprint() / 2 ** 20)
+
+    def get(self, chat_id: int) -> Optional[UserRecord]:
+        return self._records.get(chat_id)
+
+    def all(self) -> List[UserRecord]:
+        with self._lock:
+            return list(self._records.values())
+
+    def add(self, user: User) -> UserRecord:
+        """Добавляет пользователя в базу данных и в реестр."""
+        self.repository.add(user)
+        record = UserRecord(user.id, user.name, user.latitude, user.longitude, user.city, user.last_update)
+        with self._lock:
+            self._records[record.id] = record
+        return record
+
+    def update_location(self, chat_id: int, latitude: float, longitude: float, city: Optional[str] = None) -> None:
+        """Обновляет местоположение пользователя в базе данных и в реестре."""
+        user = self.repository.get(chat_id)
+        user.latitude = latitude
+        user.longitude = longitude
+        user.city = city
+        self.repository.commit()
+        record = self._records[chat_id]
+        record.latitude = latitude
+        record.longitude = longitude
+        record.city = city
+
+    def set_city(self, chat_id: int, city: str) -> None:
+        """Записывает город пользователя в базу данных и в реестр."""
+        user = self.repository.get(chat_id)
+        user.city = city
+        self.repository.commit()
+        self._records[chat_id].city = city
+
+    def fill_cities(self, lookup: Callable[[float, float], Optional[str]], batch_size: int = 1000) -> int:
+        """Определяет город по координатам для пользователей, у которых он не заполнен,
+        и записывает его пакетами по batch_size в базу данных и в реестр. Возвращает число заполненных городов."""
+        with self._lock:
+            records = [record for record in self._records.values() if record.city is None]
+        found = []
+        for record in records:
+            city = lookup(record.latitude, record.longitude)
+            if city:
+                found.append((record, city))
+        for start in range(0, len(found), batch_size):
+            batch = found[start:start + batch_size]
+            with session_scope() as session:
+                session.bulk_update_mappings(User, [{'id': record.id, 'city': city} for record, city in batch])
+            for record, city in batch:
+                record.city = city
+        if found:
+            logger.info('Заполнен город для пользователей: %s из %s без города.', len(found), len(records))
+        return len(found)
+
+    def touch(self, chat_id: int, updated: datetime) -> None:
+        """Обновляет время последнего сообщения в реестре, в базу оно записывается через LastMessageWriter."""
+        record = self._records.get(chat_id)
+        if record:
+            record.last_update = updated
+
+    def footprint(self, sample_size: int = 1000) -> int:
+        """Оценка памяти, занимаемой реестром, в байтах.
+        Размер записи с ее полями измеряется на выборке из sample_size записей."""
+        with self._lock:
+            size = sys.getsizeof(self._records)
+            count = len(self._records)
+            sample = list(islice(self._records.items(), sample_size))
+        if not sample:
+            return size
+        sample_bytes = 0
+        for chat_id, record in sample:
+            sample_bytes += sys.getsizeof(chat_id) + sys.getsizeof(record)
+            sample_bytes += sum(sys.getsizeof(getattr(record, field)) for field in UserRecord.__slots__[1:])
+        return size + sample_bytes * count // len(sample)
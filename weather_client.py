@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from log_config import payload
+from metrics import WEATHER_RESPONSES, WEATHER_SECONDS
+from quota import INTERACTIVE, QuotaManager
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+def request_error(error: requests.RequestException) -> str:
+    """Метка ошибки запроса для метрики ответов API."""
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        return 'connection_error'
+    return 'request_error'
+
+
+class CircuitBreaker:
+    """Автоматический выключатель запросов к API.
+    После failure_threshold неудач подряд запросы не выполняются reset_timeout секунд,
+    затем пропускается один пробный запрос: если он удачный - выключатель замыкается снова."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Возвращает True, если запрос можно выполнить."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probe or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._probe = True
+            return True
+
+    def cancel(self) -> None:
+        """Разрешенный запрос не был выполнен: пробный запрос можно будет выполнить снова."""
+        with self._lock:
+            self._probe = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probe or self._failures >= self.failure_threshold:
+                logger.error('Выключатель запросов к API разомкнут на %s с.', self.reset_timeout)
+                self._opened_at = time.monotonic()
+                self._probe = False
+
+
+class WeatherClient:
+    """Клиент API погоды с пулом keep-alive соединений, таймаутами на соединение и чтение,
+    ограниченным числом повторов со случайной задержкой и автоматическим выключателем.
+    Если задан quota, каждая попытка запроса списывается из квоты, а при исчерпанной квоте запрос не выполняется."""
+
+    def __init__(self,
+                 url: str,
+                 api_key: str,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 10,
+                 retries: int = 2,
+                 backoff: float = 0.5,
+                 pool_size: int = 20,
+                 breaker: Optional[CircuitBreaker] = None,
+                 quota: Optional[QuotaManager] = None) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.quota = quota
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_forecast(self,
+                     latitude: float,
+                     longitude: float,
+                     priority: str = INTERACTIVE,
+                     wait: Optional[float] = None) -> Optional[dict]:
+        """Запрашивает прогноз по координатам. Возвращает ответ API либо None.
+        priority - приоритет запроса при списании из квоты, wait - сколько секунд ждать квоту
+        (по умолчанию - как задано в квоте для приоритета)."""
+        if not self.breaker.allow():
+            logger.error('Запрос к API не выполнен: выключатель разомкнут.')
+            WEATHER_RESPONSES.inc('breaker_open')
+            return None
+        try:
+            return self._request(latitude, longitude, priority, wait)
+        except BaseException:
+            # Выключатель должен узнать результат любого разрешенного запроса,
+            # иначе после неудачного пробного запроса он останется разомкнутым навсегда
+            self.breaker.record_failure()
+            raise
+
+    def _request(self, latitude: float, longitude: float, priority: str, wait: Optional[float]) -> Optional[dict]:
+        params = {'lat': latitude,
+                  'lon': longitude,
+                  'lang': 'ru',
+                  'units': 'metric',
+                  'appid': self.api_key}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                logger.warning('Повтор запроса к API через %.2f с, попытка %s.', delay, attempt + 1)
+                time.sleep(delay)
+            if self.quota and not self.quota.acquire(priority, wait):
+                WEATHER_RESPONSES.inc('quota_exceeded')
+                self.breaker.cancel()
+                return None
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url=self.url, params=params, timeout=self.timeout)
+            except requests.RequestException as error:
+                logger.error('Не удалось выполнить запрос к API. Ошибка: %s.', error)
+                WEATHER_SECONDS.observe(time.perf_counter() - start)
+                WEATHER_RESPONSES.inc(request_error(error))
+                continue
+            WEATHER_SECONDS.observe(time.perf_counter() - start)
+            WEATHER_RESPONSES.inc(response.status_code)
+            if response.status_code in RETRY_STATUSES:
+                logger.error('Запрос к API вернул статус %s.', response.status_code)
+                continue
+            # API ответил, дальнейшие ошибки не связаны с его доступностью
+            self.breaker.record_success()
+            try:
+                data = response.json()
+            except ValueError as error:
+                logger.error('Не удалось разобрать ответ API. Ошибка: %s.', error)
+                return None
+            if str(data.get('cod')) == '200':
+                return data
+            logger.error('Запрос к API вернул не статус 200. Response: %s.', payload(data))
+            return None
+        self.breaker.record_failure()
+        return None
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncWeatherClient:
+    """Асинхронный интерфейс к WeatherClient.
+    Запросы выполняются в отдельном пуле потоков поверх того же пула соединений,
+    поэтому несколько местоположений можно запросить параллельно, не блокируя цикл событий."""
+
+    def __init__(self, client: WeatherClient, max_workers: Optional[int] = None) -> None:
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or client.pool_size,
+                                            thread_name_prefix='weather')
+
+    async def get_forecast(self, latitude: float, longitude: float, priority: str = INTERACTIVE) -> Optional[dict]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.client.get_forecast, latitude, longitude, priority)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,307 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+from typing import Any, List, Optional
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+from telegram import Bot, TelegramError, Update
+from telegram.ext import Dispatcher, JobQueue
+from telegram.utils.request import Request
+
+import log_config
+import metrics
+from geocoder import Geocoder
+
+load_dotenv()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', os.cpu_count() or 1))
+WEBHOOK_THREADS = int(os.getenv('WEBHOOK_THREADS', 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+WEBHOOK_MAX_RESTARTS = int(os.getenv('WEBHOOK_MAX_RESTARTS', 5))
+WEBHOOK_MAX_BODY = 2 ** 20
+
+# Раз в сколько секунд проверять процессы-обработчики и за какой период считать их перезапуски
+SUPERVISE_INTERVAL = 1
+RESTART_WINDOW = 60
+HEALTH_PATH = '/healthz'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Обновления, в которых есть чат: по нему обновление направляется в процесс
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request')
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(data: dict) -> int:
+    """Ключ распределения обновления по процессам: id чата, иначе id отправителя, иначе номер обновления.
+    Все обновления одного пользователя попадают в один процесс и в один поток и обрабатываются по порядку."""
+    for field in CHAT_UPDATES:
+        if field in data:
+            return data[field]['chat']['id']
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return data.get('update_id', 0)
+
+
+def worker_file(path: str, number: int) -> str:
+    """Отдельный файл процесса-обработчика: main.log -> main.worker0.log."""
+    name, extension = os.path.splitext(path)
+    return f'{name}.worker{number}{extension}'
+
+
+def run_worker(number: int, workers: int, updates: multiprocessing.Queue, threads: int) -> None:
+    """Процесс-обработчик обновлений.
+    Обновления из очереди updates распределяются по threads потокам по id чата и обрабатываются
+    обработчиками из main. Ежедневную рассылку запускает только процесс с номером 0.
+    None в очереди - сигнал остановки: процесс дообрабатывает принятые обновления и завершается."""
+    # Лог каждого процесса пишется в свой файл, LOG_FILE нужно задать до импорта main
+    log_config.LOG_FILE = worker_file(log_config.LOG_FILE, number)
+    # Процесс останавливает мастер через очередь, сигналы группе процессов (Ctrl+C, остановка systemd)
+    # не должны завершать его раньше, чем будут дообработаны принятые обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import main as bot
+
+    bot.user_registry.load()
+    if number == 0:
+        # Города пользователей без города достаточно заполнить в базе одному процессу
+        bot.fill_cities()
+    bot.forecast_cache.load()
+    bot.last_message_writer.start()
+    bot.forecast_refresher.start()
+    # У каждого процесса свои метрики: свой порт, начиная с METRICS_PORT, и свой файл
+    metrics.start(bot.METRICS_HOST, bot.METRICS_PORT + number if bot.METRICS_PORT else 0,
+                  worker_file(bot.METRICS_DUMP_FILE, number) if bot.METRICS_DUMP_FILE else None,
+                  bot.METRICS_DUMP_INTERVAL)
+    telegram_bot = Bot(token=bot.TOKEN, request=Request(con_pool_size=threads + 4))
+    job_queue = JobQueue() if number == 0 else None
+    dispatcher = Dispatcher(telegram_bot, Queue(), workers=1, job_queue=job_queue)
+    bot.add_handlers(dispatcher)
+    delivery = None
+    if job_queue:
+        # Пользователей добавляют все процессы, поэтому перед рассылкой реестр перечитывается из базы
+        delivery = bot.start_broadcasts(dispatcher, reload_users=workers > 1)
+        job_queue.start()
+
+    def process(queue: Queue) -> None:
+        while True:
+            data = queue.get()
+            if data is None:
+                return
+            try:
+                dispatcher.process_update(Update.de_json(data, telegram_bot))
+            except Exception as error:
+                logger.exception('Ошибка при обработке обновления: %s.', error)
+
+    queues = [Queue() for _ in range(threads)]
+    pool = [threading.Thread(target=process, args=(queue,), name=f'webhook_{index}')
+            for index, queue in enumerate(queues)]
+    for thread in pool:
+        thread.start()
+    logger.info('Процесс-обработчик %s запущен, потоков: %s.', number, threads)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        queues[shard_key(data) // workers % threads].put(data)
+
+    logger.info('Процесс-обработчик %s останавливается, дообработка принятых обновлений.', number)
+    for queue in queues:
+        queue.put(None)
+    for thread in pool:
+        thread.join()
+    if job_queue:
+        job_queue.stop()
+        delivery.stop()
+    dispatcher.stop()
+    bot.forecast_refresher.stop()
+    bot.last_message_writer.stop()
+    logger.info('Процесс-обработчик %s остановлен.', number)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP сервер, принимающий обновления от Telegram и передающий их процессам-обработчикам.
+    Обновление ставится в очередь процесса с номером chat_id % число процессов, поэтому обновления
+    одного пользователя обрабатываются одним процессом по порядку. Если очередь процесса заполнена
+    или процесс завершился, сервер отвечает 503 и Telegram повторит отправку обновления позже."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, path: str, secret: Optional[str], queues: List[multiprocessing.Queue],
+                 processes: List[multiprocessing.Process]) -> None:
+        super().__init__(address, WebhookHandler)
+        self.webhook_path = path
+        self.secret = secret
+        self.queues = queues
+        self.processes = processes
+        self.draining = False
+
+    def dispatch(self, data: dict) -> bool:
+        """Ставит обновление в очередь процесса-обработчика.
+        False - если очередь заполнена или процесс завершился: обновление из очереди завершенного процесса
+        было бы потеряно, а так Telegram повторит его отправку."""
+        number = shard_key(data) % len(self.queues)
+        if not self.processes[number].is_alive():
+            logger.error('Процесс-обработчик %s не работает, обновление %s отклонено.', number,
+                         data.get('update_id'))
+            return False
+        try:
+            self.queues[number].put_nowait(data)
+        except Full:
+            logger.warning('Очередь процесса-обработчика %s заполнена, обновление %s отклонено.', number,
+                           data.get('update_id'))
+            return False
+        return True
+
+    def health(self) -> dict:
+        workers = [{'number': number, 'alive': process.is_alive(), 'queue': queue.qsize()}
+                   for number, (process, queue) in enumerate(zip(self.processes, self.queues))]
+        healthy = not self.draining and all(worker['alive'] for worker in workers)
+        return {'status': 'ok' if healthy else 'unavailable', 'draining': self.draining, 'workers': workers}
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: WebhookServer
+
+    def do_POST(self) -> None:
+        if self.path != self.server.webhook_path:
+            self._reply(404)
+            return
+        if self.server.secret and self.headers.get(SECRET_HEADER) != self.server.secret:
+            logger.warning('Получен запрос без верного секрета от %s.', self.client_address[0])
+            self._reply(403)
+            return
+        if self.server.draining:
+            self._reply(503)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > WEBHOOK_MAX_BODY:
+            self._reply(413)
+            return
+        try:
+            data = json.loads(self.rfile.read(length))
+            if not isinstance(data, dict):
+                raise TypeError('обновление должно быть объектом JSON')
+            accepted = self.server.dispatch(data)
+        except (ValueError, KeyError, TypeError) as error:
+            logger.error('Не удалось разобрать обновление. Ошибка: %s.', error)
+            self._reply(400)
+            return
+        self._reply(200 if accepted else 503)
+
+    def do_GET(self) -> None:
+        if self.path != HEALTH_PATH:
+            self._reply(404)
+            return
+        health = self.server.health()
+        self._reply(200 if health['status'] == 'ok' else 503, json.dumps(health).encode())
+
+    def _reply(self, status: int, body: bytes = b'') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+def main() -> None:
+    """Запуск бота в режиме webhook: HTTP сервер и WEBHOOK_WORKERS процессов-обработчиков."""
+    log_config.setup_logging()
+    token = os.getenv('TELEGRAM_TOKEN')
+    if not all((token, os.getenv('API_KEY'), WEBHOOK_URL)):
+        logger.critical('Не найдены переменные виртуального окружения')
+        sys.exit()
+
+    # Схема базы данных создается при импорте database. Это нужно сделать до запуска процессов,
+    # иначе они создают таблицы одновременно и часть из них падает
+    import database  # noqa: F401
+    # Индекс городов строится один раз до запуска процессов, процессы только читают его
+    try:
+        Geocoder().prepare()
+    except (OSError, ValueError) as error:
+        logger.error('Не удалось построить индекс городов. Ошибка: %s.', error)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_WORKERS)]
+
+    def start_worker(number: int) -> multiprocessing.Process:
+        process = context.Process(target=run_worker, args=(number, WEBHOOK_WORKERS, queues[number], WEBHOOK_THREADS),
+                                  name=f'webhook_worker_{number}')
+        process.start()
+        return process
+
+    processes = [start_worker(number) for number in range(WEBHOOK_WORKERS)]
+
+    server = WebhookServer((WEBHOOK_HOST, WEBHOOK_PORT), urlparse(WEBHOOK_URL).path or '/', WEBHOOK_SECRET,
+                           queues, processes)
+    server_thread = threading.Thread(target=server.serve_forever, name='webhook_server')
+    server_thread.start()
+    api_kwargs = {'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+    try:
+        Bot(token=token).set_webhook(url=WEBHOOK_URL, api_kwargs=api_kwargs)
+    except TelegramError as error:
+        logger.error('Не удалось установить webhook %s. Ошибка: %s.', WEBHOOK_URL, error)
+    logger.info('Webhook сервер запущен на %s:%s, процессов-обработчиков: %s.', WEBHOOK_HOST, WEBHOOK_PORT,
+                len(processes))
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    # Упавший процесс-обработчик перезапускается с той же очередью. Если процессы падают чаще
+    # WEBHOOK_MAX_RESTARTS раз за RESTART_WINDOW секунд, сервер останавливается с ошибкой,
+    # чтобы его перезапустил менеджер процессов, а не обслуживалась только часть чатов
+    restarts: List[float] = []
+    failed = False
+    while not stop.wait(SUPERVISE_INTERVAL):
+        for number, process in enumerate(processes):
+            if process.is_alive():
+                continue
+            now = time.monotonic()
+            restarts = [restart for restart in restarts if now - restart < RESTART_WINDOW] + [now]
+            if len(restarts) > WEBHOOK_MAX_RESTARTS:
+                logger.critical('Процессы-обработчики падают слишком часто, webhook сервер останавливается.')
+                failed = True
+                stop.set()
+                break
+            logger.error('Процесс-обработчик %s завершился с кодом %s и будет перезапущен.', process.name,
+                         process.exitcode)
+            processes[number] = start_worker(number)
+
+    logger.info('Остановка webhook сервера, дообработка принятых обновлений.')
+    server.draining = True
+    server.shutdown()
+    server.server_close()
+    for queue in queues:
+        try:
+            queue.put(None, timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except Full:
+            logger.error('Не удалось передать сигнал остановки процессу-обработчику.')
+    for process in processes:
+        process.join(WEBHOOK_DRAIN_TIMEOUT)
+        if process.is_alive():
+            logger.error('Процесс-обработчик %s не завершился за %s с и будет остановлен.', process.name,
+                         WEBHOOK_DRAIN_TIMEOUT)
+            process.terminate()
+    logger.info('Webhook сервер остановлен.')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()